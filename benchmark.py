@@ -0,0 +1,306 @@
+#!/usr//bin/python3
+"""
+Benchmark of pSync. Generates a synthetic directory tree and measures phases of the scan (walk, hash, database, copy)
+and whole runs of pSync.py across algorithms, buffer sizes and numbers of workers. Results are printed as JSON, so
+they can be compared between versions
+"""
+import json
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pSync
+from pSync import Params, parse_size
+
+default_distribution = '4K:60,64K:30,1M:9,32M:1'  # Size of generated files and how often it is used
+all_phases = ('walk', 'hash', 'database', 'copy', 'run')
+
+
+def main():
+    if Params.param_exists("-help") or Params.param_exists("-h") or Params.param_exists("/?"):
+        print("Usage: " + sys.argv[0] + " [-n files] [--sizes distribution] [--seed seed] [-a algorithms]"
+                                        " [--buffer-sizes sizes] [-j jobs] [--copy-jobs jobs] [--repeat count]"
+                                        " [--phases phases] [-w work_directory] [--keep] [-o output]")
+        print("-n number of generated files, default 1000")
+        print("--sizes sizes of generated files with their weights, default %s. Files get random size between half "
+              "and one and half of the chosen size" % default_distribution)
+        print("--seed seed of the generated tree, the same seed gives the same sizes, default 0")
+        print("-a algorithms to measure, default all that read the files: %s" % ','.join(default_algorithms()))
+        print("--buffer-sizes read buffer sizes to measure, default 1M,16M")
+        print("-j numbers of hashing workers to measure, default 1,%d" % os.cpu_count())
+        print("--copy-jobs numbers of copying workers to measure, default 1,4")
+        print("--repeat how many times is every measurement repeated, default 3")
+        print("--phases measured phases, default %s. run measures whole pSync.py runs: first run, unchanged run and "
+              "run with 1%% of files modified" % ','.join(all_phases))
+        print("-w directory where the tree is generated, default is a temporary directory")
+        print("--keep do not delete the generated tree")
+        print("-o where to save the results, default prints them")
+        exit(0)
+
+    files_count = int(Params.get_param('-n') or 1000)
+    distribution = parse_distribution(Params.get_param('--sizes') or default_distribution)
+    seed = int(Params.get_param('--seed') or 0)
+    algorithms = get_list('-a', default_algorithms())
+    buffer_sizes = [parse_size(size) for size in get_list('--buffer-sizes', ['1M', '16M'])]
+    jobs = [int(count) for count in get_list('-j', ['1', str(os.cpu_count())])]
+    copy_jobs = [int(count) for count in get_list('--copy-jobs', ['1', '4'])]
+    repeat = int(Params.get_param('--repeat') or 3)
+    phases = get_list('--phases', all_phases)
+    work_dir = Params.get_param('-w')
+    keep = Params.param_exists('--keep')
+    output = Params.get_param('-o')
+
+    for algorithm in algorithms:
+        if algorithm not in pSync.hash_algorithms:
+            print('Unknown algorithm "%s"' % algorithm)
+            exit(1)
+    if distribution is None or None in buffer_sizes:
+        print('Sizes have to be numbers, K, M and G suffixes can be used')
+        exit(1)
+    for phase in phases:
+        if phase not in all_phases:
+            print('Unknown phase "%s"' % phase)
+            exit(1)
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='pSync_benchmark_')
+    work_dir = os.path.abspath(work_dir) + os.sep
+    tree_dir = work_dir + 'tree' + os.sep
+    target_dir = work_dir + 'target' + os.sep
+    database_path = work_dir + 'hashes.db'
+
+    log('Generating %d files in %s' % (files_count, tree_dir))
+    files = generate_tree(tree_dir, files_count, distribution, seed)
+    total_size = sum(files.values())
+    results = {
+        'pSync': pSync.version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'tree': {'files': files_count, 'bytes': total_size, 'sizes': Params.get_param('--sizes') or
+                 default_distribution, 'seed': seed},
+        'results': [],
+    }
+
+    def add_result(phase, times, processed_files=files_count, processed_bytes=None, **settings):
+        """Adds measured phase to results, rates are computed from the fastest try"""
+        result = {'phase': phase}
+        result.update(settings)
+        result['ns'] = min(times)
+        result['tries_ns'] = times
+        result['files_per_second'] = processed_files * 10 ** 9 / max(min(times), 1)
+        if processed_bytes is not None:
+            result['bytes_per_second'] = processed_bytes * 10 ** 9 / max(min(times), 1)
+        results['results'].append(result)
+        log('%s %s: %.3f s' % (phase, ' '.join('%s=%s' % item for item in settings.items()), min(times) / 10 ** 9))
+
+    try:
+        if 'walk' in phases:
+            add_result('walk', measure(lambda: sum(1 for _ in pSync.list_files(tree_dir, directories=False)), repeat))
+
+        if 'hash' in phases:
+            for algorithm in algorithms:
+                for buffer_size in buffer_sizes:
+                    for job_count in jobs:
+                        add_result('hash', measure(lambda: hash_tree(tree_dir, algorithm, job_count, buffer_size),
+                                                   repeat),
+                                   processed_bytes=total_size, algorithm=algorithm, buffer_size=buffer_size,
+                                   jobs=job_count)
+
+        if 'database' in phases:
+            records = hash_tree(tree_dir, 'sha256')
+            add_result('database', measure(lambda: save_records(database_path, records), repeat,
+                                           lambda: remove_file(database_path)), operation='insert')
+            add_result('database', measure(lambda: scan_records(database_path, records), repeat),
+                       operation='unchanged_scan')
+
+        if 'copy' in phases:
+            for job_count in copy_jobs:
+                add_result('copy', measure(lambda: pSync.copy_files(list(files), tree_dir, target_dir, job_count),
+                                           repeat, lambda: remove_directory(target_dir)),
+                           processed_bytes=total_size, jobs=job_count)
+
+        if 'run' in phases:
+            modified_files = sorted(files)[::100]  # 1% of files
+            for algorithm in algorithms:
+                for job_count in jobs:
+                    arguments = ['-d', tree_dir, '-t', target_dir, '-s', database_path, '-a', algorithm, '-j',
+                                 str(job_count), '--no-info']
+
+                    def first_run_setup():
+                        remove_file(database_path)
+                        remove_directory(target_dir)
+
+                    add_result('run', measure(lambda: run_pSync(arguments), repeat, first_run_setup),
+                               processed_bytes=total_size, run='first', algorithm=algorithm, jobs=job_count)
+                    add_result('run', measure(lambda: run_pSync(arguments), repeat), run='unchanged',
+                               algorithm=algorithm, jobs=job_count)
+                    add_result('run', measure(lambda: run_pSync(arguments), repeat,
+                                              lambda: modify_files(tree_dir, modified_files, files)),
+                               processed_files=len(modified_files),
+                               processed_bytes=sum(files[file] for file in modified_files), run='modified',
+                               algorithm=algorithm, jobs=job_count)
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(output, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+
+def default_algorithms():
+    """
+    :return: list of registered algorithms that read the files
+    """
+    return [name for name, (hash_function, _) in pSync.hash_algorithms.items() if hash_function is not None]
+
+
+def get_list(param_name, default):
+    """
+    :param param_name: name of parameter with comma separated values
+    :param default: list returned when the parameter is not set
+    :return: list of values
+    """
+    value = Params.get_param(param_name)
+    return list(default) if value is None else value.split(',')
+
+
+def parse_distribution(distribution):
+    """
+    Parses sizes of generated files
+    :param distribution: comma separated sizes with weights, like 4K:90,1M:10
+    :return: list of (size, weight) tuples or None when it is not valid
+    """
+    sizes = []
+    for item in distribution.split(','):
+        size, _, weight = item.partition(':')
+        size = parse_size(size)
+        try:
+            weight = float(weight or 1)
+        except ValueError:
+            return None
+        if size is None:
+            return None
+        sizes.append((size, weight))
+    return sizes
+
+
+def generate_tree(directory, files_count, distribution, seed):
+    """
+    Generates files with random content, 100 files in a directory
+    :param directory: where the files are generated, ending with separator
+    :param files_count: number of files
+    :param distribution: list of (size, weight) tuples, see parse_distribution
+    :param seed: seed of the sizes
+    :return: dictionary, key is file name relative to directory, value is its size
+    """
+    generator = random.Random(seed)
+    sizes = generator.choices([size for size, _ in distribution], [weight for _, weight in distribution],
+                              k=files_count)
+    files = {}
+    for i, size in enumerate(sizes):
+        file = os.path.join('%04d' % (i // 10000), '%02d' % (i // 100 % 100), '%06d.bin' % i)
+        size = generator.randint(size // 2, size + size // 2)
+        os.makedirs(os.path.dirname(directory + file), exist_ok=True)
+        with open(directory + file, 'wb') as f:
+            f.write(os.urandom(size))
+        files[file] = size
+    return files
+
+
+def modify_files(directory, modified_files, files):
+    """Rewrites given files with new content of the same size"""
+    for file in modified_files:
+        with open(directory + file, 'wb') as f:
+            f.write(os.urandom(files[file]))
+
+
+def hash_tree(directory, algorithm, jobs=1, buffer_size=None):
+    """
+    Hashes all files in directory like a scan without saved hashes does
+    :return: list of (file name, hash, stat) tuples
+    """
+    entries = ((entry, None) for entry in pSync.list_files(directory, directories=False))
+    return [(file[len(directory):], file_hash, file_stat) for file, _, file_stat, file_hash, _, _ in
+            pSync.hash_files(entries, algorithm, jobs=jobs, buffer_size=buffer_size)]
+
+
+def save_records(database_path, records):
+    """Saves hashes into a new database like the first scan does"""
+    database = pSync.HashDatabase(database_path, 0)
+    database.begin_scan()
+    for file, file_hash, file_stat in records:
+        database.insert(file, file_hash, file_stat)
+        database.mark_found(file, 'indexed')
+    database.delete_unfound()
+    database.finish_scan()
+    database.close()
+
+
+def scan_records(database_path, records):
+    """Looks up saved hashes and marks files found like a scan that finds no changes does"""
+    database = pSync.HashDatabase(database_path, 0)
+    database.begin_scan()
+    for i in range(0, len(records), pSync.HashDatabase.batch_size):
+        batch = [file for file, _, _ in records[i:i + pSync.HashDatabase.batch_size]]
+        database.lookup(batch)
+        for file in batch:
+            database.mark_found(file)
+    database.delete_unfound()
+    database.finish_scan()
+    database.close()
+
+
+def run_pSync(arguments):
+    """Runs pSync.py in a new process"""
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pSync.py')] +
+                   arguments, stdout=subprocess.DEVNULL, check=True)
+
+
+def measure(function, repeat, setup=None):
+    """
+    Measures how long function runs
+    :param function: measured function without parameters
+    :param repeat: how many times is the function run
+    :param setup: function called before every run, it is not measured
+    :return: list of times of every run in nanoseconds
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        time_start = time.perf_counter_ns()
+        function()
+        times.append(time.perf_counter_ns() - time_start)
+    return times
+
+
+def remove_file(path):
+    if os.path.isfile(path):
+        os.remove(path)
+    for suffix in ('-wal', '-shm'):  # Left by SQLite
+        if os.path.isfile(path + suffix):
+            os.remove(path + suffix)
+
+
+def remove_directory(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def log(message):
+    """Prints progress, results themselves are printed to standard output"""
+    print(message, file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    Params()  # Init params
+    main()
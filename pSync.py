@@ -16,14 +16,52 @@ THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABI
 CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 IN THE SOFTWARE.
 """
+import ctypes
+import ctypes.util
+import errno
 import hashlib
+import itertools
+import json
+import mmap
 import os.path
+import queue
+import select
+import struct
 import sys
 import shutil
 import sqlite3
+import stat
+import threading
 import time
+import urllib.parse
+from collections import deque
+from copy import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 version = "Aardonyx"
+copy_chunk_size = 64 * 1024 * 1024  # How many bytes are copied at once when copying files into target directory
+temp_file_suffix = '.pSync_tmp'  # Files are copied into target directory under this suffix first
+read_buffer_size = 16 * 1024 * 1024  # Default size of the buffer files are read into when hashing
+small_file_size = 1024 * 1024  # Files up to this size are read at once
+read_ahead = 2  # How many chunks of a file are read ahead while the current one is hashed
+recheck_tries = 10  # How many times at most is a suspicious file read again with --recheck
+delta_file_size = 64 * 1024 * 1024  # Modified files from this size are updated in backup only in changed blocks
+delta_block_size = 1024 * 1024  # Size of blocks compared when updating files in backup
+checkpoint_interval = 60  # How often (in seconds) is the progress of the scan saved, so it can be resumed
+progress_interval = 10  # How often (in seconds) is the progress of the scan printed with --progress
+watch_debounce = 2  # In watch mode, changes are synced once nothing changed for this many seconds
+watch_max_delay = 30  # In watch mode, changes are synced after this many seconds even when files keep changing
+watch_poll_interval = 60  # How often (in seconds) is directory scanned in watch mode when inotify is not available
 
 
 def main():
@@ -31,348 +69,1393 @@ def main():
         print('pSync v%s' % version)
         exit(0)
 
+    query = Params.param_exists('--find') or Params.param_exists('--duplicates')  # Only database given by -s is read
     if len(Params.sys_args) == 0 or Params.param_exists("-help") or Params.param_exists("-h") \
-            or Params.param_exists("/?") or Params.get_param('-d') is None:
+            or Params.param_exists("/?") or (Params.get_param('-d') is None and not
+                                             (query and Params.get_param('-s') is not None)):
         print("Usage: " + sys.argv[0] + " -d source_directory [-t target_directory] [-a algorithm] [-c]"
-                                        " [-s hash file] [-r] [-v] [-V] [--no-sql [--allow-rename]] "
-                                        "[--abs] [--no-info] [--recheck]")
+                                        " [-s hash file] [-r] [-v] [-V] [--no-sql [--no-rename]] "
+                                        "[--abs] [--no-info] [--recheck [tries]] [-j jobs] [--paranoid] "
+                                        "[--copy-jobs jobs] [--single-pass] [--buffer-size size] [--resume] [--full] "
+                                        "[--watch] [--store store_directory] [--stats-json [file]] [--progress] "
+                                        "[--root-jobs jobs] [--find hash] [--duplicates]")
         print("-s where to save hashes")
         print("-t where to move modified file")
-        print("-a algorithm to use, default SHA256. Available: sha512 (super-secure), sha256 (default), "
-              "sha1 (good-enough for home data), md5 (fast, but weak),"
-              "time (super fast, takes file's last modification time and size)")
+        print("-a algorithm to use, default is the one saved in hash file or SHA256. Available: %s" %
+              ', '.join('%s (%s)' % (name, description) for name, (_, description) in hash_algorithms.items()))
         print("-c wait for confirmation before copying files")
         print("-v verbose")
         print("-V prints version and exits")
         print("--no-sql do NOT use sql database instead of txt file (saves disk usage)")
-        print('--allow-rename passing this will cause no-sql mode to look for renamed files. Can take very long time')
+        print('--no-rename do NOT look for renamed files in no-sql mode (saves memory of the hash index)')
         print("--abs save file absolute paths of the files in database")
         print("--no-info prints just list of modified files")
-        print("--recheck when a modified file is found, this tell us to look again if there was an error")
+        print("--recheck when a file has different hash but the same size and modification time, read it again from "
+              "the disk until the same hash is read twice, at most %d times or given number of times, so a read "
+              "error is not taken for a change. With --no-sql, which does not save them, every file with different "
+              "hash is read again" % recheck_tries)
+        print("-j number of files hashed in parallel, default 1")
+        print("--paranoid rehash all files, even when their size and modification time did not change since last run")
+        print("--copy-jobs number of files copied or deleted in parallel, default 4")
+        print("--single-pass with -t, copy files while they are hashed, so changed files are read only once")
+        print("--buffer-size how many bytes are read from a file at once when hashing, K, M and G suffixes can be "
+              "used, default 16M")
+        print("--resume continue interrupted scan, files verified before the interruption are not hashed again")
+        print("--full list all directories, even those that did not change since last run (only in sql mode)")
+        print("--watch after the scan keep watching the directory and sync changed files as soon as they are found "
+              "(only in sql mode)")
+        print("--store instead of -t, back up into a store where every unique content is saved only once, the "
+              "directory tree is made of hard links and a manifest")
+        print("--stats-json save time spent in every phase of the run with numbers of processed files and bytes as "
+              "JSON into this file, without the file prints it")
+        print("--progress print number of scanned files, hashing speed and estimated remaining time every %d seconds"
+              % progress_interval)
+        print("-d can be given more times, the directories are scanned at once into one database given by -s (only in "
+              "sql mode, without -t, --store and --watch)")
+        print("--root-jobs number of source directories scanned at once, default 4")
+        print("--find print files with given hash in all source directories saved in the database given by -s")
+        print("--duplicates print files with the same content saved in more source directories in the database given "
+              "by -s")
+        exit(0)
+
+    if query:
+        query_database(Params.get_param('-s'), Params.get_param('--find'), Params.param_exists('--duplicates'))
         exit(0)
+    source_dirs = Params.get_params('-d')
+    if len(source_dirs) > 1:
+        scan_roots(source_dirs)
+        exit(0)
+
+    try:
+        config = Config.from_params()
+        engine = SyncEngine(config)
+    except SyncError as e:
+        print(e)
+        exit(1)
+    stats_json = Params.get_param('--stats-json')  # If set, stats of the run are saved into this file, or printed
+    watched_changes = None  # (changed directories, changed directory trees) found by watcher, None to scan everything
+    try:
+        while True:
+            for change in engine.scan(watched_changes):
+                if config.verbose or change.kind not in (Change.OK, Change.INDEXED):
+                    print(change)
+            if engine.scans == 1 and not engine.first_scan and not engine.has_changes():  # Not printed when watching
+                print('No modifications made')
+            if not engine.sync():
+                print('Ok, by then')
+                exit(0)
+            if Params.param_exists('--stats-json'):
+                save_stats(stats_json, engine.stats, engine.algorithm, engine.source_dir)
+            if config.show_info:
+                print('Done')
+
+            if engine.watcher is None:
+                break
+            config.show_info = False  # Following scans print only found changes
+            watched_changes = engine.wait()
+    except SyncError as e:
+        print(e)
+        exit(1)
+    finally:
+        engine.close()
+
 
+def scan_roots(source_dirs):
     """
-    When we are here, it means we have:
-    -d parameter that points us to the source directory
+    Scans more source directories into one database given by command line parameters, see MultiScanner
+    :param source_dirs: list of scanned directories
     """
-    time_start = int(round(time.time() * 1000))  # Time when this script started. Saved in SQL database
+    stats_json = Params.get_param('--stats-json')
+    try:
+        config = Config.from_params()
+        scanner = MultiScanner(config, source_dirs)
+    except SyncError as e:
+        print(e)
+        exit(1)
+    try:
+        for change in scanner.scan():
+            if config.verbose or change.kind not in (Change.OK, Change.INDEXED):
+                print(change)
+    except SyncError as e:
+        print(e)
+        exit(1)
+    finally:
+        scanner.close()
+    if config.show_info:
+        for root_scanner in scanner.scanners:
+            print('%s: found %d files, %d added, %d changed, deleted %d, renamed %d' % (
+                root_scanner.source_dir, root_scanner.files_count, len(root_scanner.new_files),
+                len(root_scanner.modified_files), len(root_scanner.deleted_files), len(root_scanner.renamed_files)))
+    if not scanner.has_changes() and not all(root_scanner.first_scan for root_scanner in scanner.scanners):
+        print('No modifications made')
+    if Params.param_exists('--stats-json'):
+        save_stats(stats_json, scanner.stats, scanner.scanners[0].algorithm, scanner.source_dirs)
+    if config.show_info:
+        print('Done')
 
-    source_dir = Params.get_param("-d")  # Path to the directory that is hashed
-    # For better formatting make sure that this directory path is complete
-    if source_dir is not None and not source_dir.endswith(os.sep):
-        source_dir += os.sep
 
-    relative_file_names = not Params.param_exists("--abs")  # Shall we save absolute file paths in database?
-    verbose = Params.param_exists('-v')  # When true prints really much output about progress
-    target_dir = Params.get_param('-t')  # If set, modified files will be copied into this directory
-    wait_for_confirmation = Params.param_exists('-c')  # If set, ask user before actions like coping
-    use_sql = not Params.param_exists("--no-sql")  # Use plaintext vs sql database format
-    list_only = Params.param_exists("--no-info")  # Do not print info about how many files were listed etc
-    no_sql_allow_rename = Params.param_exists("--allow-rename")
-    recheck_hash = Params.param_exists('--recheck')
+def query_database(path, find_hash=None, duplicates=False):
+    """
+    Prints files with the same content from all source directories saved in the database
+    :param path: path to the database
+    :param find_hash: if set, files with this hash are printed
+    :param duplicates: if set to True, prints files whose content is saved in more source directories
+    """
+    if path is None or not os.path.isfile(path):
+        print('Database "%s" does not exist' % path)
+        exit(1)
+    try:
+        database = HashDatabase(path, 0, read_only=True)
+        try:
+            if find_hash is not None:
+                for _, file in database.find_hash(find_hash.lower()):
+                    print(file)
+            if duplicates:
+                for file_hash, files in database.duplicates():
+                    print(file_hash)
+                    for _, file in files:
+                        print('  ' + file)
+        finally:
+            database.close()
+    except sqlite3.DatabaseError as e:
+        print('Database "%s" is invalid: %s' % (path, e))
+        exit(1)
 
-    # For better formatting make sure that this directory path is complete
-    if target_dir is not None and not target_dir.endswith(os.sep):
-        target_dir += os.sep
 
-    # Select right path for the file with hashes
-    if Params.param_exists("-s"):
-        save_hash_file_path = Params.get_param("-s")
-    else:
-        save_hash_file_path = get_file_name(source_dir) + "_hash"
-        if use_sql:
-            save_hash_file_path += ".db"
-        else:
-            save_hash_file_path += ".txt"
-    # When not using SQL mode, better save new hashes into another temp file, not overwriting current hashes
-    # Otherwise old hashes can be lost on process terminating
-    save_hash_file_path_tmp = save_hash_file_path + "_tmp"
-
-    # Select algorithm, default is sha256
-    algorithm = Params.get_param('-a')
-    if algorithm is None:
-        algorithm = 'sha256'
-
-    if recheck_hash and not list_only:
-        print('Warning: Recheck is enabled. This can take a long time.')
-
-    # If file with hashes already exists, load them and check if they changed
-    mode_check = os.path.isfile(save_hash_file_path)
-
-    modified_files = []  # List with paths to modified files
-    deleted_files = []  # List with paths to deleted file
-    new_files = []  # List of new files
-    renamed_hashes = []  # List of hashes that have been renamed
-    renamed_files = {}  # Keys are files before renaming, values are their new names
-    no_modifications = True  # False when any file is added/changed/deleted
-
-    hash_file_writer = None  # In clear text mode this is writer to temp file where hashes are stored
-
-    # Create SQL connection
-    if use_sql:
-        sql_conn = sqlite3.connect(save_hash_file_path)
-        sql = sql_conn.cursor()
+def save_stats(path, stats, algorithm, source):
+    """
+    Saves stats of the run as JSON, see Stats
+    :param path: where to save the stats, None prints them
+    :param stats: saved Stats
+    :param algorithm: used hash algorithm
+    :param source: scanned directory or list of directories
+    """
+    report = {'version': version, 'algorithm': algorithm, 'source': source, 'phases': stats.report()}
+    if path is None:
+        print(json.dumps(report, indent=2))
     else:
-        sql_conn = sql = None
+        with open(path, 'wt') as f:
+            json.dump(report, f, indent=2)
 
-    # Load hashes from database/data file
-    if mode_check:
-        if not list_only:
-            print('Loading saved hashes')
-        hashes = {}  # Dictionary with hashes - key is file path, value is file hash
-        if use_sql:
-            sql.execute("UPDATE hashes SET found=0")
-            if not list_only:
-                print('%d hashes loaded' % sql.execute("SELECT COUNT(*) FROM hashes").fetchone()[0])
-        else:
-            with open(save_hash_file_path, 'rt') as f:
-                hashes_txt = f.read().split('\n')
-            for line in hashes_txt:
-                if len(line) == 0:
-                    continue
-                split = line.split(" ", 1)
-                if len(split) == 2:
-                    hashes[split[1]] = split[0]
-                else:
-                    if not list_only:
-                        print('Wrong formatted line ' + line)
-            hash_file_writer = open(save_hash_file_path_tmp, 'wt')  # Better not overwrite already saved hashes
-            if not list_only:
-                print('%d hashes loaded' % len(hashes))
 
-    # Not checking -> first run -> create new database/data file
-    else:
-        if use_sql:
-            sql.execute('CREATE TABLE "hashes" ( `file` TEXT NOT NULL UNIQUE, `hash` TEXT NOT NULL,'
-                        ' `modified` INTEGER NOT NULL DEFAULT 0, `found` INTEGER NOT NULL DEFAULT 1 )')
-        else:
-            hash_file_writer = open(save_hash_file_path, 'wt')  # Better not overwrite already saved hashes
+class SyncError(Exception):
+    """Raised when a scan cannot be done, the message is meant for the user"""
 
-    # List all files (not directories) that will be hashed
-    if not list_only:
-        print('Listing directory')
-    files = list_files(source_dir, directories=False)
 
-    if files is None:
-        print(source_dir + " is not a valid file/directory.")
-        exit(1)
+class Change:
+    """
+    Change of a file found by Scanner.scan. Kind is one of constants below
+    """
+    NEW = 'new'
+    MODIFIED = 'modified'
+    DELETED = 'deleted'
+    RENAMED = 'renamed'
+    INDEXED = 'indexed'  # File found by the first scan, when there are no saved hashes yet
+    OK = 'ok'  # File did not change
 
-    if not list_only:
-            print('Found %d files' % len(files))
-    for file_index, file in enumerate(files):
-        if not os.path.isfile(file):
-            # If file does not exist, but during listing did, it was deleted during hashing process
-            deleted_files.append(file)
-            continue
-        file_hash = get_file_hash(file, algorithm, recheck_hash, verbose)
-        if file_hash is None:
-            print('Unknown algorithm "%s"' % algorithm)
-            exit(0)
+    __slots__ = ('kind', 'file', 'old_file', 'file_hash', 'root')
+
+    def __init__(self, kind, file, old_file=None, file_hash=None, root=None):
+        """
+        :param kind: what happened to the file
+        :param file: file name, relative to source directory unless absolute names are used
+        :param old_file: name of the file before renaming
+        :param file_hash: current hash of the file, None when it is not known, like for deleted files
+        :param root: source directory of the file when more directories are scanned, see MultiScanner
+        """
+        self.kind = kind
+        self.file = file
+        self.old_file = old_file
+        self.file_hash = file_hash
+        self.root = root
+
+    def __str__(self):
+        root = self.root or ''
+        if self.kind == Change.RENAMED:
+            return 'RENAMED %s to %s' % (root + self.old_file, root + self.file)
+        return '%s %s' % (self.kind.upper(), root + self.file)
+
+    def __repr__(self):
+        return 'Change(%r, %r, %r)' % (self.kind, self.file, self.old_file)
+
+
+class Config:
+    """
+    Settings of Scanner and SyncEngine. Attributes match command line parameters, see main. Directories do not have to
+    end with separator
+    """
+
+    def __init__(self, source_dir, **settings):
+        """
+        :param source_dir: directory that is scanned
+        :param settings: values of attributes below
+        """
+        self.source_dir = source_dir
+        self.hash_file = None  # Where hashes are saved, by default next to the working directory, see get_file_name
+        self.target_dir = None  # If set, changed files are copied into this directory
+        self.store_dir = None  # If set, changed files are backed up into ContentStore in this directory
+        self.algorithm = None  # Hash algorithm, by default the one saved in hash file or sha256
+        self.use_sql = True  # Save hashes into SQL database instead of text file
+        self.relative_file_names = True  # Save file names relative to source directory instead of absolute paths
+        self.allow_rename = True  # Look for renamed files in text mode too
+        self.recheck = False  # Read suspicious files again until the same hash is read twice, see recheck_file_hash
+        self.recheck_tries = recheck_tries  # How many times at most is a suspicious file read again
+        self.paranoid = False  # Do not trust file size and modification time, always rehash
+        self.jobs = 1  # How many files are hashed at once
+        self.copy_jobs = 4  # How many files are copied to target directory at once
+        self.single_pass = False  # Copy files into target directory while hashing them
+        self.buffer_size = read_buffer_size  # Read buffer for hashing
+        self.resume = False  # Continue interrupted scan
+        self.full_scan = False  # List directories even when their modification time did not change
+        self.named_root = False  # Save files under the path of source directory, so more can share one database
+        self.root_jobs = 4  # How many source directories are scanned at once, see MultiScanner
+        self.watch = False  # Watch source directory for changes, see SyncEngine.watch
+        self.verbose = False  # Print every hashed, copied and deleted file
+        self.show_info = False  # Print info about the scan, like how many files were found
+        self.show_progress = False  # Print progress of the scan every progress_interval seconds
+        self.confirm = None  # Function asked with a question before changes are applied, None applies them
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError('Unknown setting "%s"' % name)
+            setattr(self, name, value)
+
+    @staticmethod
+    def from_params():
+        """
+        Reads settings from command line parameters
+        :return: Config
+        """
+        try:
+            jobs = int(Params.get_param('-j') or 1)
+            copy_jobs = int(Params.get_param('--copy-jobs') or 4)
+            root_jobs = int(Params.get_param('--root-jobs') or 4)
+            tries = int(Params.get_param('--recheck') or recheck_tries)
+        except ValueError:
+            raise SyncError('-j, --copy-jobs, --root-jobs and --recheck have to be positive numbers')
+        return Config(Params.get_param('-d'),
+                      hash_file=Params.get_param('-s'),
+                      target_dir=Params.get_param('-t'),
+                      store_dir=Params.get_param('--store'),
+                      algorithm=Params.get_param('-a'),
+                      use_sql=not Params.param_exists('--no-sql'),
+                      relative_file_names=not Params.param_exists('--abs'),
+                      allow_rename=not Params.param_exists('--no-rename'),
+                      recheck=Params.param_exists('--recheck'),
+                      recheck_tries=tries,
+                      paranoid=Params.param_exists('--paranoid'),
+                      jobs=jobs,
+                      copy_jobs=copy_jobs,
+                      single_pass=Params.param_exists('--single-pass'),
+                      buffer_size=parse_size(Params.get_param('--buffer-size') or str(read_buffer_size)),
+                      resume=Params.param_exists('--resume'),
+                      full_scan=Params.param_exists('--full'),
+                      root_jobs=root_jobs,
+                      watch=Params.param_exists('--watch'),
+                      verbose=Params.param_exists('-v'),
+                      show_info=not Params.param_exists('--no-info'),
+                      show_progress=Params.param_exists('--progress'),
+                      confirm=input_yes_no if Params.param_exists('-c') else None)
+
+
+class Scanner:
+    """
+    Finds files that changed in a directory since the previous scan. Hashes are kept in SQL database or text file,
+    the database stays open between scans of the same Scanner. Lists of files found by the last scan are kept in
+    attributes, so they can be applied to a backup, see SyncEngine
+    """
+
+    def __init__(self, config):
+        """
+        Checks settings and starts watching the directory when watch mode is on
+        :param config: Config
+        :raise SyncError: when settings cannot be used
+        """
+        self.config = config
+        self.source_dir = os.path.abspath(config.source_dir)  # Path to the directory that is hashed
+        # For better formatting make sure that directory paths are complete
+        if os.path.isdir(self.source_dir) and not self.source_dir.endswith(os.sep):
+            self.source_dir += os.sep
+        self.target_dir = config.target_dir
+        if self.target_dir is not None and not self.target_dir.endswith(os.sep):
+            self.target_dir += os.sep
+        self.store_dir = config.store_dir
+        if self.store_dir is not None and not self.store_dir.endswith(os.sep):
+            self.store_dir += os.sep
+        if config.jobs < 1 or config.copy_jobs < 1 or config.root_jobs < 1:
+            raise SyncError('-j, --copy-jobs and --root-jobs have to be positive numbers')
+        if config.buffer_size is None or config.buffer_size < 1:
+            raise SyncError('--buffer-size has to be a positive size, like 1048576 or 1M')
+        if self.target_dir is not None and self.store_dir is not None:
+            raise SyncError('-t and --store cannot be used together')
+
+        # Select right path for the file with hashes
+        self.hash_file = config.hash_file
+        if self.hash_file is None:
+            self.hash_file = get_file_name(self.source_dir) + "_hash" + (".db" if config.use_sql else ".txt")
+        # When not using SQL mode, better save new hashes into another temp file, not overwriting current hashes
+        # Otherwise old hashes can be lost on process terminating. It also holds progress for resuming
+        self.hash_file_tmp = self.hash_file + "_tmp"
+
+        # Algorithm is taken from hash file by the first scan when it is not set
+        self.algorithm = config.algorithm
+        if self.algorithm is not None and self.algorithm not in hash_algorithms:
+            raise SyncError('Unknown algorithm "%s"' % self.algorithm)
+
+        if config.watch and not config.use_sql:
+            raise SyncError('--watch cannot be used with --no-sql')
+        if config.watch and not os.path.isdir(self.source_dir):
+            raise SyncError('--watch requires source directory')
+
+        self.single_pass = config.single_pass and self.target_dir is not None
+        if config.single_pass and not self.single_pass and config.show_info:
+            print('Warning: --single-pass requires -t, it will be ignored.')
 
-        if relative_file_names:
-            file = file[len(source_dir):]  # Strip source directory path from the file path
+        if config.named_root and not (config.use_sql and config.relative_file_names):
+            raise SyncError('More source directories can be saved only in sql mode with relative file names')
 
-        line = file
+        self.resume = config.resume  # Only the first scan continues interrupted one
+        self.stats = Stats()  # Stats of the last scan and sync, shared by scanners of MultiScanner
+        self.reset_stats = True  # Set to False when stats are collected for more scanners, see MultiScanner
+        self.scans = 0  # Number of finished scans
+        self.database = None  # HashDatabase, opened by the first scan in SQL mode
+        self.hash_file_writer = None  # In clear text mode this is writer to temp file where hashes are stored
+        self.store = None  # ContentStore opened when store_dir is set
+        # Watch for changes from the start, so changes done during the first scan are not missed
+        self.watcher = DirectoryWatcher(self.source_dir, config.show_info) if config.watch else None
 
-        if not use_sql:
-            hash_file_writer.write(file_hash + " " + file + "\n")
+        # Results of the last scan
+        self.first_scan = True  # True when there were no saved hashes, so all files were indexed
+        self.modified_files = []  # List with paths to modified files
+        self.deleted_files = []  # List with paths to deleted file
+        self.new_files = []  # List of new files
+        self.renamed_files = {}  # Keys are files before renaming, values are their new names
+        self.copied_files = {}  # Files copied while hashing, keys are file names, values are paths of the source files
+        self.stored_hashes = {}  # Hashes of new and modified files for the store, keys are file names
+        # Modified files whose changed blocks are known, keys are file names, values are tuples (size, mtime_ns,
+        # list of changed blocks), size and mtime_ns are from previous run. See copy_files
+        self.delta_files = {}
+        self.hashes = {}  # In clear text mode, saved hashes not found by running scan yet, see _scan
+        self.files_count = 0  # Number of found files
+        self.time_scan_start = time.perf_counter()
 
-        force_verbose = False
+    def _info(self, message):
+        """Prints info about the scan unless it is turned off"""
+        if self.config.show_info:
+            print(message)
+
+    def copy_target(self, path):
+        """Picks temporary file in target directory where a file is copied while it is hashed. Text database does not
+        know if saved files changed, so only new files are copied while hashing"""
+        if not self.config.use_sql and not self.first_scan and \
+                (path[len(self.source_dir):] if self.config.relative_file_names else path) in self.hashes:
+            return None
+        return self.target_dir + path[len(self.source_dir):] + temp_file_suffix
+
+    def single_pass_target(self, entry, record):
+        """Picks where a file is copied while it is hashed, see copy_target. In SQL mode, a file without saved record
+        that has the size and inode of a saved file not found yet is most likely renamed, so it is not copied,
+        renaming it in target directory is enough. When it turns out to be new, it is copied after the scan"""
+        if record is None and self.config.use_sql and not self.first_scan:
+            try:
+                file_stat = entry.stat()
+            except OSError:
+                return None
+            if file_stat.st_ino and self.database.has_unfound_stat(file_stat.st_size, file_stat.st_ino):
+                return None
+        return self.copy_target(entry.path)
+
+    def scan(self, watched_changes=None):
+        """
+        Scans the directory, compares files with saved hashes and saves new hashes. When the scan is not finished,
+        because of an error or because the generator was closed, it can be resumed like an interrupted process
+        :param watched_changes: tuple (changed directories, changed directory trees) returned by wait, only files in
+         them are scanned. None scans everything
+        :return: generator of Change, deleted files are found at the end
+        :raise SyncError: when the scan cannot be done
+        """
+        try:
+            yield from self._scan(watched_changes)
+        except BaseException:
+            self._abort()
+            raise
+
+    def _scan(self, watched_changes):
+        config = self.config
+        source_dir = self.source_dir
+        relative_file_names = config.relative_file_names
+        use_sql = config.use_sql
+        no_sql_allow_rename = config.allow_rename
+        resume = self.resume
+        if not os.path.exists(source_dir):
+            raise SyncError(source_dir + " is not a valid file/directory.")
+        if self.reset_stats:
+            self.stats.reset()
+        self.time_scan_start = time.perf_counter()
+        time_start = int(round(time.time() * 1000))  # Time when this scan started. Saved in SQL database
+        # If file with hashes already exists, load them and check if they changed
+        mode_check = os.path.isfile(self.hash_file)
+        self.first_scan = not mode_check
+
+        modified_files = self.modified_files = []
+        deleted_files = self.deleted_files = []
+        new_files = self.new_files = []
+        renamed_files = self.renamed_files = {}
+        copied_files = self.copied_files = {}
+        stored_hashes = self.stored_hashes = {}
+        delta_files = self.delta_files = {}
+        renamed_hashes = set()  # Hashes that have been renamed
+        # Files taken as source of a rename by this scan. Their records can be looked up before that, with the file
+        # listed later, so such record is not used, the file found at the old name is new
+        renamed_sources = set()
+        track_blocks = use_sql and self.target_dir is not None  # Hashes of blocks are saved only for backups
+
+        # Create SQL connection
+        if use_sql and self.database is None:
+            root = source_dir.rstrip(os.sep) or os.sep
+            self.database = HashDatabase(self.hash_file, time_start, config.show_info,
+                                         root if config.named_root else None, stats=self.stats)
+            if not config.named_root and relative_file_names and root in self.database.roots():
+                # Scanned together with other directories before, its files are saved under its named root
+                self.database.close()
+                self.database = HashDatabase(self.hash_file, time_start, config.show_info, root, stats=self.stats)
+            if self.database.new_root:  # Other roots are saved in the database, but this one is scanned first time
+                mode_check = self.first_scan = False
+        database = self.database
+
+        # Load hashes from database/data file
+        time_load_start = time.perf_counter()
+        saved_count = 0  # Number of saved hashes, files expected to be found
+        hashes = self.hashes = {}  # Dictionary with hashes - key is file path, value is file hash packed by pack_hash
+        hashes_files = {}  # Reverse of hashes used to look for renamed files - key is packed hash, value is file
+        # or list of files when there are more files with the same hash
         if mode_check:
-            file_already_hashed = False
-            database_hash = None
+            self._info('Loading saved hashes')
             if use_sql:
-                sql_result = sql.execute("SELECT hash FROM hashes WHERE file=?", (file,)).fetchone()
-                if sql_result is not None and len(sql_result) > 0:
-                    file_already_hashed = True
-                    database_hash = sql_result[0]
-                del sql_result
+                saved_algorithm = database.get_info('algorithm')
+                if config.show_info or config.show_progress:
+                    saved_count = database.count()
+                self._info('%d hashes loaded' % saved_count)
             else:
-                if file in hashes:
-                    file_already_hashed = True
-                    database_hash = hashes[file]
-            if file_already_hashed:
-                if file_hash == database_hash:
-                    line = 'OK ' + line
-                    if use_sql:
-                        sql.execute("UPDATE hashes SET found=1 "
-                                    "WHERE file=?", (file,))
-                else:
-                    force_verbose = True
-                    no_modifications = False
-                    line = 'MODIFIED ' + line
+                saved_algorithm = None
+                # Read line by line, so the whole file is never in memory together with the loaded hashes
+                with open(self.hash_file, 'rt') as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if len(line) == 0:
+                            continue
+                        if line.startswith('#pSync '):  # Hashes never start with #, so this cannot be a file
+                            if line.startswith('#pSync algorithm='):
+                                saved_algorithm = line[len('#pSync algorithm='):]
+                            continue
+                        split = line.split(" ", 1)
+                        if len(split) == 2:
+                            packed_hash = pack_hash(split[0])
+                            hashes[split[1]] = packed_hash
+                            if no_sql_allow_rename:
+                                add_file_hash(hashes_files, split[1], packed_hash)
+                        else:
+                            self._info('Wrong formatted line ' + line)
+                saved_count = len(hashes)
+                self._info('%d hashes loaded' % saved_count)
+
+        # Not checking -> first run -> data file is created below, SQL database creates its tables by itself
+        else:
+            saved_algorithm = None
+
+        self.stats.add('load', time.perf_counter() - time_load_start, hashes=saved_count)
+
+        # Hashes made by different algorithm cannot be compared, all files would appear as modified
+        if self.algorithm is None:
+            self.algorithm = saved_algorithm or 'sha256'
+        elif saved_algorithm is not None and saved_algorithm != self.algorithm:
+            raise SyncError('Hashes in "%s" were made by algorithm "%s", cannot check them with "%s"' %
+                            (self.hash_file, saved_algorithm, self.algorithm))
+        algorithm = self.algorithm
+        if algorithm not in hash_algorithms:
+            raise SyncError('Unknown algorithm "%s"' % algorithm)
+        if self.store_dir is not None and self.store is None:
+            if hash_algorithms[algorithm][0] is None:
+                raise SyncError('--store cannot be used with algorithm "%s", it does not identify content' % algorithm)
+            self.store = ContentStore(self.store_dir, algorithm)
+            if self.store.algorithm != algorithm:
+                raise SyncError('Store "%s" is made by algorithm "%s", cannot use it with "%s"' % (
+                    self.store_dir, self.store.algorithm, algorithm))
+        # Pick up changes found by interrupted scan, when resuming, files it verified are skipped
+        done_files = set()  # In clear text mode, files verified by the resumed scan
+        interrupted_changes = None  # List of (change, file, file before renaming) found by interrupted scan
+        if use_sql:
+            database.set_info('algorithm', algorithm)
+            interrupted_changes = database.begin_scan(resume, time_start)
+            if watched_changes is not None:
+                database.limit_scan(*[[path[len(source_dir):] if relative_file_names else path for path in paths]
+                                      for paths in watched_changes])
+        elif resume and os.path.isfile(self.hash_file_tmp):
+            interrupted_changes, interrupted_algorithm = load_interrupted_hashes(self.hash_file_tmp, done_files)
+            if interrupted_algorithm is not None and interrupted_algorithm != algorithm:
+                raise SyncError('Interrupted scan used algorithm "%s", cannot resume it with "%s"' % (
+                    interrupted_algorithm, algorithm))
+            for file in done_files:
+                if mode_check and file in hashes:
+                    if no_sql_allow_rename:
+                        forget_file_hash(hashes_files, file, hashes[file])
+                    del hashes[file]
+            self.hash_file_writer = open(self.hash_file_tmp, 'at')
+            if interrupted_algorithm is None:  # Interrupted before anything was saved
+                self.hash_file_writer.write('#pSync algorithm=%s\n' % algorithm)
+        else:
+            self.hash_file_writer = open(self.hash_file_tmp, 'wt')  # Better not overwrite already saved hashes
+            self.hash_file_writer.write('#pSync algorithm=%s\n' % algorithm)
+        hash_file_writer = self.hash_file_writer
+        if interrupted_changes is not None:
+            self._info('Continuing interrupted scan' if resume else
+                       'Previous scan was interrupted, scanning again. Use --resume to continue it instead')
+            for change, file, old_file in interrupted_changes:
+                if change == 'modified':
                     modified_files.append(file)
-                    if use_sql:
-                        sql.execute("UPDATE hashes SET hash=?, modified=?, found=1 "
-                                    "WHERE file=?", (file_hash, time_start, file))
-                if not use_sql:
-                    hashes.pop(file, None)  # Delete this hash from memory when found
-            else:
-                # File appears to be new, but we will check if it is not just renamed (if we have it already hashed)
-                file_is_renamed = False  # Can be False or name of file before renaming
+                elif change == 'renamed':
+                    renamed_files[old_file] = file
+                    if not use_sql and mode_check and old_file in hashes:
+                        if no_sql_allow_rename:
+                            forget_file_hash(hashes_files, old_file, hashes[old_file])
+                        del hashes[old_file]
+                else:
+                    new_files.append(file)
+                yield Change(change, file, old_file)
+
+        # List all files (not directories) that will be hashed. Files are hashed while the listing still runs
+        self._info('Listing and hashing directory')
+        files_count = 0
+        time_scan_start = time_checkpoint = time_progress = time.perf_counter()
+        scanned_count = 0  # Files that got their verdict
+        listing_cache = DirectoryListingCache(database, source_dir, relative_file_names,
+                                              mode_check and not config.full_scan) if use_sql else None
+        if watched_changes is None:
+            listed_files = list_files(source_dir, directories=False, listing_cache=listing_cache)
+        else:  # Only directories where something changed are listed, see DirectoryWatcher.wait
+            changed_directories, changed_trees = watched_changes
+            listed_files = itertools.chain(
+                *[list_files(path, directories=False, listing_cache=listing_cache, recursive=False)
+                  for path in changed_directories],
+                *[list_files(path, directories=False, listing_cache=listing_cache) for path in changed_trees])
+
+        def files_with_records():
+            """Pairs every listed file with its record (hash, size, mtime_ns, inode) saved during previous run.
+            Records are looked up for a whole batch of listed files at once. Files verified by resumed scan are
+            skipped"""
+            nonlocal files_count
+            batch = []
+            for entry in itertools.chain(self.stats.timed('listing', listed_files), [None]):
+                if entry is not None:
+                    files_count += 1
+                    batch.append(entry)
+                    if len(batch) < HashDatabase.batch_size:
+                        continue
+                names = [batch_entry.path[len(source_dir):] if relative_file_names else batch_entry.path
+                         for batch_entry in batch]
+                records = {}
+                batch_done_files = done_files
+                if use_sql and batch:
+                    if mode_check:
+                        records = database.lookup(names)
+                    if resume:
+                        batch_done_files = database.lookup_done(names)
+                for batch_entry, name in zip(batch, names):
+                    if name not in batch_done_files:
+                        yield batch_entry, records.get(name)
+                batch = []
+
+        for file, record, file_stat, file_hash, file_copied, file_blocks in hash_files(
+                files_with_records(), algorithm, config.recheck_tries if config.recheck else 0, config.verbose,
+                config.jobs, config.paranoid, self.single_pass_target if self.single_pass else None, config.buffer_size,
+                track_blocks, self.stats):
+            source_file = file
+            scanned_count += 1
+            if relative_file_names:
+                file = file[len(source_dir):]  # Strip source directory path from the file path
+            if file_copied:
+                copied_files[file] = source_file
+
+            if file_hash is None:
+                # If file does not exist, but during listing did, it was deleted during hashing process
+                # It stays unfound, so it gets reported as deleted when the scan ends
+                continue
+
+            # Saved with the file, so resumed scan knows what was found: new, modified, renamed or indexed
+            change = None
+            file_is_renamed = False  # Can be False or name of file before renaming
+
+            if mode_check:
+                file_already_hashed = False
+                database_hash = None
                 if use_sql:
-                    sql_result = sql.execute("SELECT file FROM hashes WHERE hash=?", (file_hash,)).fetchone()
-                    if sql_result is not None and len(sql_result) == 1 and file_hash not in renamed_hashes:
-                        # When we have more than 1 file with same hash it database it means that we have multiple copies
-                        # of the same file. Therefore cannot we say which of them was renamed.
-                        file_is_renamed = sql_result[0]
-                        renamed_hashes.append(file_hash)
-                        sql.execute("UPDATE hashes SET file=?, modified=?, found=1 "
-                                    "WHERE file=?", (file, time_start, file_is_renamed))
+                    if record is not None and file not in renamed_sources:
+                        file_already_hashed = True
+                        database_hash = record[0]
                 else:
-                    really_do_not_care_about_time_i_spend_computing = no_sql_allow_rename
-                    # When True, we have to go through WHOLE database for EVERY single file
-                    if really_do_not_care_about_time_i_spend_computing and file_hash not in renamed_hashes:
-                        files_with_same_hashes_count = 0
-                        file_is_renamed_temp = None
-                        for database_file, database_hash in hashes.items():
-                            if database_hash == file_hash:
-                                file_is_renamed_temp = database_file
-                                files_with_same_hashes_count += 1
-                        if files_with_same_hashes_count == 1:
+                    file_hash_packed = pack_hash(file_hash)
+                    if file in hashes:
+                        file_already_hashed = True
+                        database_hash = hashes[file]
+                if file_already_hashed:
+                    if not use_sql and file_hash_packed != database_hash and config.recheck and \
+                            hash_algorithms[algorithm][0] is not None:
+                        # Text database has no size and modification time telling a read error from a change
+                        file_hash = recheck_file_hash(source_file, algorithm, file_hash, config.recheck_tries,
+                                                      config.verbose, config.buffer_size, stats=self.stats)
+                        file_hash_packed = pack_hash(file_hash)
+                    if (file_hash if use_sql else file_hash_packed) == database_hash:
+                        if use_sql and record[1:] != file_stat_values(file_stat):
+                            database.update(file, file_hash, file_stat, modified=False)
+                    else:
+                        change = 'modified'
+                        modified_files.append(file)
+                        if use_sql:
+                            database.update(file, file_hash, file_stat)
+                    if not use_sql:
+                        hashes.pop(file, None)  # Delete this hash from memory when found
+                        if no_sql_allow_rename:
+                            forget_file_hash(hashes_files, file, database_hash)
+                else:
+                    # File appears to be new, but we will check if it is not just renamed (if we have it already hashed)
+                    if use_sql:
+                        sql_result = database.find_unfound(file_hash)
+                        if len(sql_result) == 1 and file_hash not in renamed_hashes:
+                            # When we have more than 1 file with same hash it database it means that we have multiple
+                            # copies of the same file. Therefore cannot we say which of them was renamed.
+                            file_is_renamed = sql_result[0]
+                            renamed_hashes.add(file_hash)
+                            renamed_sources.add(file_is_renamed)
+                            database.rename(file_is_renamed, file, file_stat)
+                    elif no_sql_allow_rename:
+                        same_hash_files = hashes_files.get(file_hash_packed)
+                        if isinstance(same_hash_files, str) and file_hash not in renamed_hashes:
                             # When we have more than 1 file with same hash it database it means that we have
                             #  multiple copies of the same file. Therefore cannot we say which of them was renamed.
-                            file_is_renamed = file_is_renamed_temp
-                        del file_is_renamed_temp
-                    # End of if really_do_not_care_about_time_i_spend_computing:
-                if not file_is_renamed:
-                    line = 'NEW ' + line
-                    no_modifications = False
-                    force_verbose = True
-                    new_files.append(file)
-                    if use_sql:
-                        sql.execute("INSERT INTO hashes VALUES (?, ?, ?, 1)", (file, file_hash, time_start))
-                else:  # File is renamed
-                    force_verbose = True
-                    line = 'RENAMED %s to ' % file_is_renamed + line
-                    no_modifications = False
-                    renamed_files[file_is_renamed] = file  # Key is name before renaming, value is new name
+                            file_is_renamed = same_hash_files
+                            renamed_hashes.add(file_hash)
+                            hashes.pop(file_is_renamed)  # Renamed file was found, so it is not deleted
+                            forget_file_hash(hashes_files, file_is_renamed, file_hash_packed)
+                    if not file_is_renamed:
+                        change = 'new'
+                        new_files.append(file)
+                        if use_sql:
+                            database.insert(file, file_hash, file_stat)
+                    else:  # File is renamed
+                        change = 'renamed'
+                        renamed_files[file_is_renamed] = file  # Key is name before renaming, value is new name
 
-        else:
-            line = 'INDEXED ' + line
-            new_files.append(file)
+            else:
+                change = 'indexed'
+                new_files.append(file)
+                if use_sql:
+                    database.insert(file, file_hash, file_stat)
+            yield Change(change or Change.OK, file, file_is_renamed or None, file_hash)
+
+            if self.store is not None and change in ('new', 'modified', 'indexed'):
+                stored_hashes[file] = file_hash
+            if track_blocks:
+                if change == 'modified' and file_blocks is not None and not file_copied:
+                    saved_blocks = database.lookup_blocks(file)
+                    if saved_blocks is not None and saved_blocks[0] == delta_block_size:
+                        delta_files[file] = (record[1], record[2], changed_blocks(saved_blocks[1], file_blocks))
+                if change in ('new', 'modified', 'indexed') or (change is None and file_blocks is not None):
+                    database.save_blocks(file, file_blocks)
+
+            # Remember that the file was verified, together with the change that was found
             if use_sql:
-                sql.execute("INSERT INTO hashes VALUES (?, ?, ?, 1)", (file, file_hash, time_start))
-        verbose_bck = False
-        if force_verbose:
-            verbose_bck, verbose = verbose, force_verbose
-        if verbose:
-            print(line)
-        if force_verbose:
-            verbose = verbose_bck
+                database.mark_found(file, change, file_is_renamed or None)
+            else:
+                hash_file_writer.write(file_hash + " " + file + "\n")
+                if change == 'renamed':
+                    hash_file_writer.write('#pSync renamed=%s\n#pSync to=%s\n' % (file_is_renamed, file))
+                elif change is not None:
+                    hash_file_writer.write('#pSync %s=%s\n' % (change, file))
+            if time.perf_counter() - time_checkpoint >= checkpoint_interval:
+                time_checkpoint = time.perf_counter()
+                if use_sql:
+                    database.checkpoint()
+                else:
+                    hash_file_writer.flush()
+                    os.fsync(hash_file_writer.fileno())
+            if config.show_progress and time.perf_counter() - time_progress >= progress_interval:
+                time_progress = time.perf_counter()
+                hashed_size = self.stats.get('hashing', 'bytes')
+                elapsed = time_progress - time_scan_start
+                line = 'Scanned %d files, hashed %s, %s/s' % (scanned_count, format_size(hashed_size),
+                                                              format_size(hashed_size / elapsed))
+                if 0 < scanned_count < saved_count:  # Assume that about the same number of files as last time is found
+                    line += ', ETA %s' % time.strftime('%H:%M:%S', time.gmtime(
+                        (saved_count - scanned_count) * elapsed / scanned_count))
+                print(line)
+        """
+        All hashing was completed
+        """
+        self.files_count = files_count
+        self.stats.add('listing', files=files_count)
+        self.stats.add('scan', time.perf_counter() - time_scan_start, files=scanned_count,
+                       bytes=self.stats.get('hashing', 'bytes'))
+        # Copies made while hashing are kept only for files that have to be copied, others are thrown away
+        # Files found by interrupted scan can be found again when it is not resumed
+        modified_files[:] = dict.fromkeys(modified_files)
+        new_files[:] = dict.fromkeys(new_files)
+        files_to_copy = set(modified_files).union(new_files)
+        for file, source_file in list(copied_files.items()):
+            if file not in files_to_copy:
+                os.remove(self.copy_target(source_file))
+                del copied_files[file]
+        self._info('Found %d files' % files_count)
+
+        # Get files that was not found on system, but exists in database (this files were deleted)
+        if use_sql:
+            for deleted_file in database.delete_unfound():
+                hashes[deleted_file] = None
+
+        if mode_check:
+            # All files inside hashes dict were not found on the disk, so they had to be deleted
+            for deleted_file in hashes:
+                deleted_files.append(deleted_file)
+                yield Change(Change.DELETED, deleted_file)
+
+        """
+        Save databases and show info to user
+        """
+        if use_sql:
+            database.finish_scan()
+        else:
+            hash_file_writer.close()
+            self.hash_file_writer = None
+            shutil.move(self.hash_file_tmp, self.hash_file)  # Overwrite persistent hashes file
+
+        if not mode_check:
+            self._info('First indexing completed')
+        elif self.has_changes():
+            self._info('%d files added, %d changed, deleted %d, renamed %d' % (
+                len(new_files), len(modified_files), len(deleted_files), len(renamed_files)))
+        self.hashes = {}
+        self.resume = False
+        self.scans += 1
+
+    def has_changes(self):
+        """
+        :return: True when the last scan found any file added, modified, deleted or renamed
+        """
+        return len(self.modified_files) + len(self.new_files) + len(self.deleted_files) + len(self.renamed_files) > 0
+
+    def wait(self):
+        """
+        Waits until something changes in watch mode, see DirectoryWatcher.wait
+        :return: changes to pass to scan
+        """
+        if self.watcher is None:
+            raise SyncError('Directory is not watched, use --watch')
+        return self.watcher.wait()
+
+    def _abort(self):
+        """Closes the database and hash file of unfinished scan, it can be resumed from its last checkpoint"""
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+        if self.hash_file_writer is not None:
+            self.hash_file_writer.close()
+            self.hash_file_writer = None
+
+    def close(self):
+        """Closes the database and stops watching"""
+        self._abort()
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+
+class SyncEngine(Scanner):
     """
-    All hashing was completed
+    Scanner that applies found changes to a backup, either target directory or ContentStore
     """
 
-    # Get files that was not found on system, but exists in database (this files were deleted)
-    if use_sql:
-        sql_result = sql.execute("SELECT file FROM hashes WHERE found=0").fetchall()
-        for sql_row in sql_result:
-            hashes[sql_row[0]] = None
-        del sql_result
-        sql.execute("DELETE FROM hashes WHERE found=0")
+    def sync(self):
+        """
+        Copies new and modified files found by the last scan into the backup, renames renamed and deletes deleted
+        :return: False when applying the changes was not confirmed, see Config.confirm
+        """
+        config = self.config
+        changed = self.has_changes()
+        if changed and self.target_dir is not None:
+            modified_files = self.modified_files + self.new_files  # All modified files are copied, so new files too
+            deleted_files = list(self.deleted_files)
+
+            if config.confirm is not None:
+                if not config.confirm("Do you want to copy modified, rename renamed and delete removed files?"):
+                    for source_file in self.copied_files.values():
+                        os.remove(self.copy_target(source_file))
+                    return False
+                self._info('Copying changed files')
+
+            # Renamed files are renamed in backup too, only files missing in backup have to be copied again
+            if len(self.renamed_files) > 0 and hash_algorithms[self.algorithm][0] is None:
+                # Size and modification time do not identify content, the "renamed" file may be a different one
+                modified_files.extend(self.renamed_files.values())
+                deleted_files.extend(self.renamed_files.keys())
+            elif len(self.renamed_files) > 0:
+                self._info('Renaming renamed files')
+                modified_files.extend(rename_target_files(self.renamed_files, self.target_dir, config.verbose,
+                                                          self.stats))
+            for file, source_file in self.copied_files.items():
+                finish_copy(source_file, self.copy_target(source_file))
+                if config.verbose:
+                    print('Copied "%s" to "%s"' % (source_file,
+                                                   self.copy_target(source_file)[:-len(temp_file_suffix)]))
+            copy_files([file for file in modified_files if file not in self.copied_files], self.source_dir,
+                       self.target_dir, config.copy_jobs, config.verbose, config.show_info,
+                       delta_files=self.delta_files, stats=self.stats)
+
+            # Delete removed files from backup
+            if len(deleted_files) > 0:
+                self._info('Deleting removed files')
+                delete_files(deleted_files, self.target_dir, config.copy_jobs, config.verbose, self.stats)
+        if changed and self.store is not None:
+            if config.confirm is not None and not config.confirm("Do you want to store changed files?"):
+                return False
+            self._info('Storing changed files')
+            self.store.update({file: self.stored_hashes.get(file)
+                               for file in itertools.chain(self.modified_files, self.new_files)},
+                              self.renamed_files, self.deleted_files, self.source_dir, config.copy_jobs,
+                              config.verbose, config.show_info, self.stats)
+        self.stats.add('run', time.perf_counter() - self.time_scan_start, new=len(self.new_files),
+                       modified=len(self.modified_files), deleted=len(self.deleted_files),
+                       renamed=len(self.renamed_files))
+        return True
+
+    def run(self, watched_changes=None):
+        """
+        Scans the directory and applies found changes to the backup
+        :param watched_changes: see Scanner.scan
+        :return: generator of Change, the backup is updated once it is exhausted
+        """
+        yield from self.scan(watched_changes)
+        self.sync()
+
+    def watch(self):
+        """
+        Keeps the backup in sync, after the first run only directories where something changed are scanned. Never
+        ends, requires Config.watch
+        :return: generator of Change found by all runs
+        """
+        watched_changes = None
+        while True:
+            yield from self.run(watched_changes)
+            watched_changes = self.wait()
+
 
+class MultiScanner:
     """
-    Save databases and show info to user
+    Scans more source directories at once into one SQL database. Every directory is saved as a named root, see
+    HashDatabase, and scanned by its own Scanner in a pool of config.root_jobs threads. Scanners do not print info,
+    it would be mixed together, results are in their attributes
     """
-    if use_sql:
-        sql_conn.commit()
-        sql_conn.close()
-    else:
-        hash_file_writer.close()
-
-    if mode_check:
-        # All files inside hashes dict were not found on the disk, so they had to be deleted
-        for deleted_file, hash_value in hashes.items():
-            no_modifications = False
-            print('DELETED ' + deleted_file)
-            deleted_files.append(deleted_file)
-        if no_modifications:
-            print('No modifications made')
-        else:
-            if not list_only:
-                print('%d files added, %d changed, deleted %d, renamed %d' % (len(new_files), len(modified_files),
-                                                                              len(deleted_files), len(renamed_files)))
 
-        if not use_sql:  # Move clear text tmp file and overwrite persistent hashes file
-            shutil.move(save_hash_file_path_tmp, save_hash_file_path)
-    else:
-        if not list_only:
-            print('First indexing completed')
+    def __init__(self, config, source_dirs):
+        """
+        :param config: Config shared by all directories, its source_dir is ignored
+        :param source_dirs: list of scanned directories
+        :raise SyncError: when settings cannot be used
+        """
+        if not config.use_sql or config.hash_file is None:
+            raise SyncError('More source directories can be scanned only in sql mode into a database given by -s')
+        if config.target_dir is not None or config.store_dir is not None or config.watch:
+            raise SyncError('-t, --store and --watch can be used only with one source directory')
+        self.config = config
+        self.stats = Stats()  # Stats of the last scan of all directories
+        self.scanners = []
+        for source_dir in dict.fromkeys(os.path.abspath(source_dir) for source_dir in source_dirs):
+            root_config = copy(config)
+            root_config.source_dir = source_dir
+            root_config.named_root = True
+            root_config.show_info = False
+            scanner = Scanner(root_config)
+            scanner.stats = self.stats
+            scanner.reset_stats = False
+            self.scanners.append(scanner)
+        self.source_dirs = [scanner.source_dir for scanner in self.scanners]
+
+    def scan(self):
+        """
+        Scans all directories, changes are reported as soon as any scanner finds them. When a scan fails, the others
+        are stopped and the error is raised
+        :return: generator of Change with root set to the source directory of the file
+        :raise SyncError: when a scan cannot be done
+        """
+        self.stats.reset()
+        time_scan_start = time.perf_counter()
+        # Create and migrate tables before the roots are scanned, so their connections do not do it all at once
+        HashDatabase(self.config.hash_file, 0, self.config.show_info).close()
+        changes = queue.Queue(1000)  # Found changes, exceptions raised by scans and None when a scan finishes
+        stopped = threading.Event()
+
+        def put(item):
+            """Waits for space in the queue, unless the scan was stopped"""
+            while not stopped.is_set():
+                try:
+                    changes.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def scan(scanner):
+            if stopped.is_set():
+                return
+            scanned = scanner.scan()
+            try:
+                for change in scanned:
+                    change.root = scanner.source_dir
+                    put(change)
+                    if stopped.is_set():
+                        return
+                put(None)
+            except BaseException as e:
+                put(e)
+            finally:
+                scanned.close()  # Scan closed before it finished stays interrupted, see Scanner.scan
+
+        with ThreadPoolExecutor(max_workers=self.config.root_jobs) as executor:
+            for scanner in self.scanners:
+                executor.submit(scan, scanner)
+            try:
+                running = len(self.scanners)
+                while running > 0:
+                    change = changes.get()
+                    if change is None:
+                        running -= 1
+                    elif isinstance(change, BaseException):
+                        raise change
+                    else:
+                        yield change
+            finally:
+                stopped.set()
+        self.stats.add('run', time.perf_counter() - time_scan_start,
+                       new=sum(len(scanner.new_files) for scanner in self.scanners),
+                       modified=sum(len(scanner.modified_files) for scanner in self.scanners),
+                       deleted=sum(len(scanner.deleted_files) for scanner in self.scanners),
+                       renamed=sum(len(scanner.renamed_files) for scanner in self.scanners))
+
+    def has_changes(self):
+        """
+        :return: True when the last scan found any change in any directory
+        """
+        return any(scanner.has_changes() for scanner in self.scanners)
+
+    def close(self):
+        """Closes databases of all scanners"""
+        for scanner in self.scanners:
+            scanner.close()
+
+
+def copy_files(files, source_dir, target_dir, jobs=1, verbose=False, show_progress=False, target_names=None,
+               delta_files=None, stats=None):
     """
-    Saving info about this session done
+    Copies files from source directory into the same place in the target directory using a pool of worker threads
+    :param files: list of file names relative to both directories
+    :param source_dir: directory files are copied from
+    :param target_dir: directory files are copied to
+    :param jobs: number of files copied at once
+    :param verbose: if set to true prints every copied file
+    :param show_progress: if set to true prints copied size, speed and estimated remaining time every few seconds
+    :param target_names: dictionary, key is file name, value is its name in target directory. By default files are
+     copied under the same name
+    :param delta_files: dictionary, key is file name, value is tuple (size, modification time in nanoseconds, list of
+     changed blocks). When target file still has the given size and modification time, only the changed blocks are
+     written into it, see update_file_blocks
+    :param stats: Stats where time and processed items are added, default_stats when not given
     """
+    if stats is None:
+        stats = default_stats
+    sizes = {}  # Key is file name, value is its size. Files that do not exist anymore are skipped
+    for file in files:
+        try:
+            sizes[file] = os.path.getsize(source_dir + file)
+        except OSError:
+            continue
+
+    def delta_size(file):
+        return min(sizes[file], len(delta_files[file][2]) * delta_block_size)
+
+    # Only changed blocks are expected to be written, unless the backup changed and the file is copied whole
+    total_size = sum(delta_size(file) if delta_files is not None and file in delta_files else size
+                     for file, size in sizes.items())
+
+    def target_file_path(file):
+        return target_dir + (target_names[file] if target_names is not None else file)
 
+    def copy(file):
+        """:return: tuple (file name, number of written blocks or None when whole file was copied, written bytes)"""
+        target_file = target_file_path(file)
+        if delta_files is not None and file in delta_files:
+            size, mtime_ns, blocks = delta_files[file]
+            try:
+                target_stat = os.stat(target_file)
+            except OSError:
+                target_stat = None
+            # Backup has to be exactly the file the blocks were compared with, otherwise it is copied whole
+            if target_stat is not None and target_stat.st_size == size and target_stat.st_mtime_ns == mtime_ns:
+                update_file_blocks(source_dir + file, target_file, blocks)
+                return file, len(blocks), delta_size(file)
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        copy_file(source_dir + file, target_file)
+        return file, None, sizes[file]
+
+    time_copy_start = time_last_progress = time.perf_counter()
+    copied_size = copied_count = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for file, written_blocks, written_size in executor.map(copy, sizes):
+            if verbose and written_blocks is not None:  # Printed from this thread only, so lines do not mix
+                print('Updated %d changed blocks of "%s"' % (written_blocks, target_file_path(file)))
+            elif verbose:
+                print('Copied "%s" to "%s"' % (source_dir + file, target_file_path(file)))
+            copied_size += written_size
+            copied_count += 1
+            time_now = time.perf_counter()
+            if show_progress and time_now - time_last_progress >= 5:
+                time_last_progress = time_now
+                speed = copied_size / (time_now - time_copy_start)
+                print('Copied %d/%d files, %s/%s, %s/s, ETA %s' % (
+                    copied_count, len(sizes), format_size(copied_size), format_size(total_size), format_size(speed),
+                    time.strftime('%H:%M:%S', time.gmtime((total_size - copied_size) / speed if speed else 0))))
+    stats.add('copy', time.perf_counter() - time_copy_start, files=copied_count, bytes=copied_size)
+    if show_progress and sizes:
+        print('Copied %d files, %s in %.1f s' % (copied_count, format_size(copied_size),
+                                                  time.perf_counter() - time_copy_start))
+
+
+def copy_file(source_file, target_file):
     """
-    If enabled, copy modified files to new location
+    Copies file content and permissions. Data are written into a temporary file first, which replaces the target file
+    only when complete, so an interrupted copy never leaves a half written file behind. Kernel side copying
+    (copy_file_range, sendfile) is used when supported, data are not passed through Python then. When it copies
+    nothing, which some file systems do instead of failing, the next way of copying is tried
+    :param source_file: file to be copied
+    :param target_file: where to copy the file
     """
-    if len(modified_files) + len(new_files) + len(deleted_files) > 0 and target_dir is not None:
-        modified_files.extend(new_files)  # All modified files are copied, so copy all new files too
+    temp_target_file = target_file + temp_file_suffix
+    try:
+        with open(source_file, 'rb') as reader, open(temp_target_file, 'wb') as writer:
+            copied = 0
+            for zero_copy in ('copy_file_range', 'sendfile'):
+                if not hasattr(os, zero_copy):
+                    continue
+                try:
+                    while True:
+                        if zero_copy == 'copy_file_range':
+                            chunk = os.copy_file_range(reader.fileno(), writer.fileno(), copy_chunk_size,
+                                                       copied, copied)
+                        else:
+                            chunk = os.sendfile(writer.fileno(), reader.fileno(), copied, copy_chunk_size)
+                        if not chunk:
+                            break
+                        copied += chunk
+                except OSError:
+                    if copied:  # Failed in the middle of the file, this is not about missing kernel support
+                        raise
+                if copied:
+                    break
+            else:
+                shutil.copyfileobj(reader, writer, copy_chunk_size)
+        finish_copy(source_file, temp_target_file)
+    except BaseException:
+        if os.path.isfile(temp_target_file):
+            os.remove(temp_target_file)
+        raise
 
-        if wait_for_confirmation:
-            if not input_yes_no("Do you want to copy modified and delete removed files?"):
-                print('Ok, by then')
-                exit(0)
-            if not list_only:
-                    print('Copying changed files')
-        for file in modified_files:
-            source_file = source_dir + file
-            target_file = target_dir + file
-            target_file_dir = os.path.dirname(target_file)
-            if not os.path.isfile(source_file):
-                continue
+
+def finish_copy(source_file, temp_target_file):
+    """
+    Copies permissions and modification time of the source file and moves completely written copy in its place in
+    target directory. The same modification time tells update_file_blocks that backup was not changed since
+    :param source_file: file that was copied
+    :param temp_target_file: copy of the file, its name is the target file with temp_file_suffix
+    """
+    shutil.copystat(source_file, temp_target_file)
+    os.replace(temp_target_file, temp_target_file[:-len(temp_file_suffix)])
+
+
+def update_file_blocks(source_file, target_file, blocks):
+    """
+    Updates backup of a modified file by writing only its changed blocks in place, the rest of the file is not read
+    nor written. Unlike copy_file, interrupted update leaves the target file partially updated
+    :param source_file: modified file
+    :param target_file: backup of the file before it was modified
+    :param blocks: list of indexes of changed delta_block_size long blocks, see changed_blocks
+    """
+    with open(source_file, 'rb') as reader, open(target_file, 'r+b') as writer:
+        for block in blocks:
+            reader.seek(block * delta_block_size)
+            writer.seek(block * delta_block_size)
+            writer.write(reader.read(delta_block_size))
+        writer.truncate(os.fstat(reader.fileno()).st_size)
+    shutil.copystat(source_file, target_file)
+
+
+def changed_blocks(old_hashes, new_hashes):
+    """
+    Compares hashes of blocks made by BlockHasher
+    :param old_hashes: hashes of blocks of the file before it was modified
+    :param new_hashes: hashes of blocks of the modified file
+    :return: list of indexes of blocks that changed or were added
+    """
+    size = BlockHasher.hash_size
+    return [block for block in range(len(new_hashes) // size)
+            if new_hashes[block * size:(block + 1) * size] != old_hashes[block * size:(block + 1) * size]]
+
+
+def delete_files(files, target_dir, jobs=1, verbose=False, stats=None):
+    """
+    Deletes files from target directory using a pool of worker threads
+    :param files: list of file names relative to the target directory
+    :param target_dir: directory files are deleted from
+    :param jobs: number of files deleted at once
+    :param verbose: if set to true prints every deleted file
+    :param stats: Stats where time and processed items are added, default_stats when not given
+    """
+    if stats is None:
+        stats = default_stats
+    def delete(file):
+        target_file = target_dir + file
+        if not os.path.isfile(target_file):
+            return None
+        os.remove(target_file)
+        return target_file
+
+    time_delete_start = time.perf_counter()
+    deleted_count = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for target_file in executor.map(delete, files):
+            if target_file is not None:
+                deleted_count += 1
+            if verbose and target_file is not None:
+                print('Deleted "%s"' % target_file)
+    stats.add('delete', time.perf_counter() - time_delete_start, files=deleted_count)
+
+
+def format_size(size):
+    """
+    Formats size in bytes to human readable form
+    :param size: number of bytes
+    :return: size with unit, like 1.5 GiB
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+        size /= 1024
+
+
+def rename_target_files(renamed_files, target_dir, verbose=False, stats=None):
+    """
+    Renames files in backup the same way as they were renamed in the source directory
+    :param renamed_files: dictionary, key is file name before renaming, value is its new name
+    :param target_dir: backup directory
+    :param verbose: if set to true prints every renamed file
+    :param stats: Stats where time and processed items are added, default_stats when not given
+    :return: list of new file names that could not be renamed in backup and have to be copied
+    """
+    if stats is None:
+        stats = default_stats
+    files_to_copy = []
+    time_rename_start = time.perf_counter()
+    for old_file, new_file in renamed_files.items():
+        old_target_file = target_dir + old_file
+        target_file = target_dir + new_file
+        target_file_dir = os.path.dirname(target_file)
+        if not os.path.isfile(old_target_file):
+            files_to_copy.append(new_file)
+            continue
+        if verbose:
+            print('Renaming "%s" to "%s"' % (old_target_file, target_file))
+        try:
             if not os.path.isdir(target_file_dir):
-                if verbose:
-                    print('Creating directory "%s"' % target_file_dir)
                 os.makedirs(target_file_dir)
-            if verbose:
-                print('Copying "%s" to "%s"' % (source_file, target_file))
-            shutil.copy(source_file, target_file)
-
-        # Delete removed files from backup
-        if len(deleted_files) > 0 and target_dir is not None:
-            print('Deleting removed files')
-            for file in deleted_files:
-                target_file = target_dir + file
-                if not os.path.isfile(target_file):
-                    continue
-                if verbose:
-                    print('Deleting "%s"' % target_file)
-                os.remove(target_file)
-    # TODO Implement renaming
+            os.replace(old_target_file, target_file)
+        except OSError:
+            files_to_copy.append(new_file)
+    stats.add('rename', time.perf_counter() - time_rename_start, files=len(renamed_files) - len(files_to_copy))
+    return files_to_copy
+
+
+def load_interrupted_hashes(path, done_files):
     """
-    Updating backup done
+    Loads clear text hashes saved by interrupted scan. Incomplete last line is cut off, so the file can be appended to
+    :param path: path to the temporary file with hashes
+    :param done_files: set, names of files that already have their hash saved are added here
+    :return: tuple (list of (change, file, file before renaming) found by the scan, algorithm used by the scan)
     """
-    if not list_only:
-        print('Done')
+    with open(path, 'rb+') as f:
+        content_size = f.seek(0, os.SEEK_END)
+        while content_size > 0:
+            f.seek(max(content_size - 65536, 0))
+            chunk = f.read(content_size - f.tell())
+            if b'\n' in chunk:
+                content_size -= len(chunk) - chunk.rindex(b'\n') - 1
+                break
+            content_size -= len(chunk)
+        f.truncate(content_size)
+    changes = []
+    algorithm = None
+    renamed_from = None
+    with open(path, 'rt') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#pSync '):
+                key, _, value = line[len('#pSync '):].partition('=')
+                if key == 'algorithm':
+                    algorithm = value
+                elif key == 'renamed':
+                    renamed_from = value
+                elif key == 'to':
+                    changes.append(('renamed', value, renamed_from))
+                else:
+                    changes.append((key, value, None))
+                continue
+            split = line.split(" ", 1)
+            if len(split) == 2:
+                done_files.add(split[1])
+    return changes, algorithm
+
 
+def pack_hash(file_hash):
+    """
+    Converts hexadecimal hash into bytes, which take half of the memory. Hashes that are not hexadecimal (time
+    algorithm) are kept as they are
+    :param file_hash: hash of the file
+    :return: bytes or the hash itself
+    """
+    try:
+        return bytes.fromhex(file_hash)
+    except ValueError:
+        return file_hash
+
+
+def unpack_hash(packed_hash):
+    """
+    Converts hash packed by pack_hash back to its original form
+    :param packed_hash: bytes or hash that was not hexadecimal
+    :return: hash of the file
+    """
+    return packed_hash.hex() if isinstance(packed_hash, bytes) else packed_hash
+
+
+def add_file_hash(hashes_files, file, file_hash):
+    """
+    Adds file to reverse hash index. Single file is saved as it is, list is created only for files with the same hash
+    :param hashes_files: dictionary, key is hash, value is file or list of files with this hash
+    :param file: file to be added
+    :param file_hash: saved hash of the file
+    """
+    same_hash_files = hashes_files.get(file_hash)
+    if same_hash_files is None:
+        hashes_files[file_hash] = file
+    elif isinstance(same_hash_files, str):
+        hashes_files[file_hash] = [same_hash_files, file]
+    else:
+        same_hash_files.append(file)
+
+
+def forget_file_hash(hashes_files, file, file_hash):
+    """
+    Removes file from reverse hash index, so it is not considered when looking for renamed files
+    :param hashes_files: dictionary, key is hash, value is file or list of files with this hash
+    :param file: file to be removed
+    :param file_hash: saved hash of the file
+    """
+    same_hash_files = hashes_files.get(file_hash)
+    if same_hash_files is None:
+        return
+    if isinstance(same_hash_files, str):
+        del hashes_files[file_hash]
+        return
+    same_hash_files.remove(file)
+    if len(same_hash_files) == 1:
+        hashes_files[file_hash] = same_hash_files[0]
 
-def list_files(directory, relative=False, files=True, directories=True):
-    """Lists all files in directory and subdirectories in absolute path form.
+
+def list_files(directory, files=True, directories=True, listing_cache=None, recursive=True):
+    """Lists all files in directory and subdirectories. Entries are yielded as soon as they are found, so the caller
+    can work on them while the listing still runs. Directories are walked without recursion, so deep trees are fine
     :param directory directory to be listed
-    :param relative if set to true, does return only relative path to the file, based on source folder
     :param files if set to False, only directories are listed
     :param directories if set to False, only files are listed
-    :return if :param directory is directory - list of all files and directories in subdirectories
-    :return if :param directory is file - list which contains only this file
-    :return otherwise None"""
-    import os
-    if not relative:
-        directory = os.path.abspath(directory)
+    :param listing_cache if set, entries of directories that did not change since they were saved into it are taken
+     from it instead of listing the directory again, see DirectoryListingCache
+    :param recursive if set to False, subdirectories are not listed
+    :return if :param directory is directory - generator of os.DirEntry of all files and directories in subdirectories
+    :return if :param directory is file - generator which yields only this file
+    :return otherwise empty generator"""
     if not os.path.isdir(directory):
-        if os.path.isfile(directory):
-            return [directory]
-        return None
-    listed_files = []
-    for file in os.listdir(directory):
-        file_path = directory + os.sep + file
-        if os.path.isdir(file_path):
-            listed_files.extend(list_files(file_path, relative, files, directories))
-            if directories:
-                listed_files.append(file_path)
-        elif files:
-            listed_files.append(file_path)
-    return listed_files
+        if files and os.path.isfile(directory):
+            yield FileEntry(directory)
+        return
+    visited_links = set()  # (device, inode) of symlinked directories that were walked, stops symlink loops
+    pending_directories = [directory]
+    while pending_directories:
+        directory_path = pending_directories.pop()
+        if listing_cache is not None:
+            try:
+                directory_stat = os.stat(directory_path)
+            except OSError:  # Deleted since its parent was listed
+                continue
+            listing = listing_cache.get(directory_path, directory_stat)
+            if listing is not None:
+                file_names, directory_names = listing
+                directory_paths = []
+                listed_links = set()  # Added to visited_links only when the saved listing is used
+                for name in directory_names:
+                    path = os.path.join(directory_path, name)
+                    if os.path.islink(path):
+                        try:
+                            link_stat = os.stat(path)
+                        except OSError:
+                            link_stat = None
+                        # Target of the link was deleted or replaced, which does not change the listed directory
+                        if link_stat is None or not stat.S_ISDIR(link_stat.st_mode):
+                            listing = None
+                            break
+                        link_key = (link_stat.st_dev, link_stat.st_ino)
+                        if link_key in visited_links or link_key in listed_links:
+                            continue
+                        listed_links.add(link_key)
+                    directory_paths.append(path)
+            if listing is not None:
+                visited_links |= listed_links
+                for path in directory_paths:
+                    if recursive:
+                        pending_directories.append(path)
+                    if directories:
+                        yield FileEntry(path, True)
+                if files:
+                    for name in file_names:
+                        yield FileEntry(os.path.join(directory_path, name))
+                continue
+        entries_count = 0
+        try:
+            entries = os.scandir(directory_path)
+        except (FileNotFoundError, NotADirectoryError):  # Deleted since its parent was listed
+            continue
+        with entries:
+            for entry in entries:
+                entries_count += 1
+                if entry.is_dir():
+                    if entry.is_symlink():
+                        try:
+                            link_stat = entry.stat()
+                        except OSError:  # Its target was deleted in the meantime
+                            continue
+                        if (link_stat.st_dev, link_stat.st_ino) in visited_links:
+                            continue
+                        visited_links.add((link_stat.st_dev, link_stat.st_ino))
+                    if recursive:
+                        pending_directories.append(entry.path)
+                    if directories:
+                        yield entry
+                elif files and entry.is_file():
+                    yield entry
+        if listing_cache is not None:
+            listing_cache.put(directory_path, directory_stat, entries_count)
 
 
 def get_file_name(path):
@@ -381,52 +1464,411 @@ def get_file_name(path):
     return tail or os.path.basename(head)
 
 
-def get_file_hash(file, algorithm, recheck=False, verbose=False):
+def get_file_hash(file, algorithm, copy_to=None, buffer_size=None, block_hasher=None, file_stat=None):
     """
     Hashes file and returns its hash
     :param file: file to be hashed
     :param algorithm: algorithm used for hashing
-    :param recheck: when set to True, hash is repeated until 2 same values are found
-    :param verbose: if set to true prints rechecking hashes
+    :param copy_to: when set, data read are also written into this file. Missing directories are created. Algorithms
+     that do not read the file do not write it either
+    :param buffer_size: how many bytes are read at once, read_buffer_size by default
+    :param block_hasher: when set, BlockHasher that is given the data of the file too
+    :param file_stat: stat of the file when the caller already has it, so the file is not looked up again
     :return: hash of the file or None when file does not exists or None when wrong algorithm is used
     """
-    if not os.path.isfile(file):
+    if algorithm not in hash_algorithms:
         return None
-    if algorithm == 'sha256':
-        hash_function = hashlib.sha256
-    elif algorithm == 'sha1':
-        hash_function = hashlib.sha1
-    elif algorithm == 'md5':
-        hash_function = hashlib.md5
-    elif algorithm == 'sha512':
-        hash_function = hashlib.sha512
-    elif algorithm == 'time':
-        return str(int(os.path.getsize(file))) + ":" + str(int(os.path.getmtime(file)))
-    else:
+    if file_stat is None:
+        try:
+            file_stat = os.stat(file)
+        except OSError:
+            return None
+    if not stat.S_ISREG(file_stat.st_mode):
         return None
+    hash_function = hash_algorithms[algorithm][0]
+    if hash_function is None:  # time
+        return str(file_stat.st_size) + ":" + str(int(file_stat.st_mtime))
 
-    file_hashes = []
-    try_num = 0
-    while True:
-        hasher = hash_function()
-        try_num += 1
-        with open(file, 'rb') as file_reader:
-            file_reader.seek(0)
-            while True:
-                file_bytes = file_reader.read(16 * 1024 * 1024)
-                if not file_bytes:
-                    break
-                hasher.update(file_bytes)
-        del file_bytes
+    hasher = hash_function()
+    try:
+        file_reader = open(file, 'rb', buffering=0)
+    except (FileNotFoundError, NotADirectoryError):  # Deleted since its stat was taken
+        return None
+    copy_writer = None
+    with file_reader:
+        if copy_to is not None:
+            os.makedirs(os.path.dirname(copy_to), exist_ok=True)
+            copy_writer = open(copy_to, 'wb')
+        for file_bytes in read_file(file_reader, buffer_size or read_buffer_size):
+            hasher.update(file_bytes)
+            if copy_writer is not None:
+                copy_writer.write(file_bytes)
+            if block_hasher is not None:
+                block_hasher.update(file_bytes)
+    if copy_writer is not None:
+        copy_writer.close()
+    return hasher.hexdigest()
+
+
+def recheck_file_hash(file, algorithm, file_hash, tries, verbose=False, buffer_size=None, block_hasher=None,
+                      stats=None):
+    """
+    Reads file again from the disk, not from the page cache, until the same hash is read twice. Used for files whose
+    content seems to have changed while their size and modification time did not, which is more likely a read error
+    or bit rot than a real change
+    :param file: file to be hashed
+    :param algorithm: algorithm used for hashing, it has to read the file
+    :param file_hash: hash of the first read
+    :param tries: how many times at most is the file read again
+    :param verbose: if set to true prints hashes of every try
+    :param buffer_size: how many bytes are read at once, read_buffer_size by default
+    :param block_hasher: when set, BlockHasher that is given the data of the file too, it is left with the blocks
+     of the read that gave the returned hash
+    :param stats: Stats where time and processed items are added, default_stats when not given
+    :return: hash that was read twice or the last one read when no hash repeated
+    """
+    if stats is None:
+        stats = default_stats
+    time_start = time.perf_counter()
+    read_size = 0
+    file_hashes = [file_hash]
+    if verbose:
+        print('Rechecking "%s"' % file)
+        print('Try 1 generated hash %s' % file_hash)
+    for try_num in range(2, tries + 2):
+        hasher = hash_algorithms[algorithm][0]()
+        if block_hasher is not None:
+            block_hasher.reset()
+        for file_bytes in read_file_uncached(file, buffer_size or read_buffer_size):
+            hasher.update(file_bytes)
+            if block_hasher is not None:
+                block_hasher.update(file_bytes)
+            read_size += len(file_bytes)
         file_hash = hasher.hexdigest()
-        if verbose and recheck:
+        if verbose:
             print('Try %d generated hash %s' % (try_num, file_hash))
-        if not recheck or file_hash in file_hashes or len(file_hashes) >= 50:
+        if file_hash in file_hashes:
             break
         file_hashes.append(file_hash)
+    stats.add('recheck', time.perf_counter() - time_start, files=1, bytes=read_size)
     return file_hash
 
 
+def read_file(file_reader, buffer_size):
+    """
+    Reads whole file in chunks. Small files are read at once, the rest is read into buffers that are reused by all
+    files read in the current thread. Files of more chunks are read ahead by another thread, see read_file_ahead.
+    Files are not memory mapped, reading a mapped file that is truncated meanwhile kills the process, while read just
+    returns less data. Kernel is told that the file is read sequentially and that its pages do not have to stay
+    cached, so scanning does not evict everything else from cache
+    :param file_reader: file opened for binary reading without buffering
+    :param buffer_size: size of the read buffer
+    :return: generator of chunks of the file, chunk is valid only until the next one is requested
+    """
+    file_descriptor = file_reader.fileno()
+    file_size = os.fstat(file_descriptor).st_size
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        if file_size <= small_file_size:
+            yield file_reader.read()
+            return
+        buffers = getattr(read_buffers, 'buffers', None)
+        if buffers is None or len(buffers[0]) != buffer_size:
+            buffers = read_buffers.buffers = [memoryview(bytearray(buffer_size)) for _ in range(read_ahead + 1)]
+        if file_size > buffer_size * 2:
+            yield from read_file_ahead(file_reader, buffers)
+            return
+        while True:
+            read_size = file_reader.readinto(buffers[0])
+            if not read_size:
+                break
+            yield buffers[0][:read_size]
+    finally:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def read_file_ahead(file_reader, buffers):
+    """
+    Reads file in another thread, so following chunks are read while the current one is processed. Reading and
+    hashing release GIL, so disk and CPU work at once
+    :param file_reader: file opened for binary reading without buffering
+    :param buffers: list of buffers, one is used by the caller and the rest are read ahead
+    :return: generator of chunks of the file, chunk is valid only until the next one is requested
+    """
+    free_buffers = queue.Queue()
+    for buffer in buffers:
+        free_buffers.put(buffer)
+    read_buffers_queue = queue.Queue()  # Tuples (buffer, read size) or (None, exception raised by reading)
+
+    def read():
+        try:
+            while True:
+                buffer = free_buffers.get()
+                if buffer is None:  # Caller stopped reading
+                    return
+                read_size = file_reader.readinto(buffer)
+                read_buffers_queue.put((buffer, read_size))
+                if not read_size:
+                    return
+        except BaseException as e:
+            read_buffers_queue.put((None, e))
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            buffer, read_size = read_buffers_queue.get()
+            if buffer is None:
+                raise read_size
+            if not read_size:
+                return
+            yield buffer[:read_size]
+            free_buffers.put(buffer)
+    finally:
+        free_buffers.put(None)
+        reader.join()  # File is closed by the caller
+
+
+def read_file_uncached(file, buffer_size):
+    """
+    Reads whole file from the disk, not from the page cache, so a reread sees what is really stored. Uses O_DIRECT
+    where the file system supports it, otherwise cached pages of the file are dropped before it is read
+    :param file: path of the file
+    :param buffer_size: size of the read buffer
+    :return: generator of chunks of the file, chunk is valid only until the next one is requested
+    """
+    direct = getattr(os, 'O_DIRECT', 0)
+    if direct:
+        try:
+            file_descriptor = os.open(file, os.O_RDONLY | direct)
+        except OSError:  # Not supported by the file system
+            direct = 0
+    if not direct:
+        with open(file, 'rb', buffering=0) as file_reader:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(file_reader.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            yield from read_file(file_reader, buffer_size)
+        return
+    # O_DIRECT reads into memory aligned to blocks of the disk, anonymous map is aligned to pages
+    buffer = getattr(read_buffers, 'aligned_buffer', None)
+    if buffer is None or len(buffer) < buffer_size:
+        buffer = read_buffers.aligned_buffer = memoryview(mmap.mmap(-1, -(-buffer_size // mmap.PAGESIZE) *
+                                                                    mmap.PAGESIZE))
+    with open(file_descriptor, 'rb', buffering=0) as file_reader:
+        while True:
+            read_size = file_reader.readinto(buffer)
+            if not read_size:
+                break
+            yield buffer[:read_size]
+
+
+read_buffers = threading.local()  # Buffers reused by read_file, one set for every thread
+
+
+class BlockHasher:
+    """
+    Hashes every delta_block_size bytes of a file separately, so changed blocks of a modified file can be found
+    without reading its backup
+    """
+    hash_size = 16  # Size of hash of one block in bytes
+
+    def __init__(self):
+        self.hashes = []
+        self.hasher = None  # Hasher of the current block
+        self.block_filled = 0  # Bytes of the current block that were hashed
+
+    def reset(self):
+        """Forgets hashed data, so the file can be hashed again"""
+        self.hashes = []
+        self.hasher = None
+
+    def update(self, data):
+        """Hashes next data of the file"""
+        offset = 0
+        while offset < len(data):
+            if self.hasher is None:
+                self.hasher = hashlib.blake2b(digest_size=self.hash_size)
+                self.block_filled = 0
+            chunk = data[offset:offset + delta_block_size - self.block_filled]
+            self.hasher.update(chunk)
+            self.block_filled += len(chunk)
+            offset += len(chunk)
+            if self.block_filled == delta_block_size:
+                self.hashes.append(self.hasher.digest())
+                self.hasher = None
+
+    def digest(self):
+        """
+        :return: hashes of all blocks joined together, the last block can be shorter
+        """
+        if self.hasher is not None:
+            self.hashes.append(self.hasher.digest())
+            self.hasher = None
+        return b''.join(self.hashes)
+
+
+def parse_size(size):
+    """
+    Parses size given by user
+    :param size: number of bytes, can end with K, M or G
+    :return: number of bytes or None when size is not valid
+    """
+    multiplier = 1
+    if size[-1:].upper() in ('K', 'M', 'G'):
+        multiplier = 1024 ** ('KMG'.index(size[-1].upper()) + 1)
+        size = size[:-1]
+    try:
+        return int(size) * multiplier
+    except ValueError:
+        return None
+
+
+def register_hash_algorithm(name, hash_function, description=''):
+    """
+    Makes algorithm available for hashing files
+    :param name: name of the algorithm, used with -a and saved with hashes
+    :param hash_function: function without parameters that returns new hasher object with update and hexdigest
+     methods, like hashlib.sha256
+    :param description: short description shown in help
+    """
+    hash_algorithms[name] = (hash_function, description)
+
+
+hash_algorithms = {}  # Key is algorithm name, value is tuple (hash function, description). Filled below
+register_hash_algorithm('sha512', hashlib.sha512, 'super-secure')
+register_hash_algorithm('sha256', hashlib.sha256, 'default')
+register_hash_algorithm('sha1', hashlib.sha1, 'good-enough for home data')
+register_hash_algorithm('md5', hashlib.md5, 'fast, but weak')
+register_hash_algorithm('blake2b', hashlib.blake2b, 'secure and faster than sha on 64-bit CPUs')
+register_hash_algorithm('blake2s', hashlib.blake2s, 'secure and faster than sha on 32-bit CPUs')
+if blake3 is not None:
+    register_hash_algorithm('blake3', blake3.blake3, 'secure and very fast')
+if xxhash is not None:
+    register_hash_algorithm('xxh3', xxhash.xxh3_64, 'not cryptographic, catches only errors, extremely fast')
+    register_hash_algorithm('xxh128', xxhash.xxh3_128, 'not cryptographic, catches only errors, extremely fast')
+# Does not read the file at all
+register_hash_algorithm('time', None, "super fast, takes file's last modification time and size")
+
+
+def get_file_hash_cached(entry, record, algorithm, recheck=0, verbose=False, paranoid=False, copy_to=None,
+                         buffer_size=None, blocks=False, stats=None):
+    """
+    Hashes file unless its size, modification time and inode are the same as during previous run
+    :param entry: os.DirEntry of the file to be hashed, as returned by list_files
+    :param record: tuple (hash, size, mtime_ns, inode) saved during previous run or None
+    :param algorithm: algorithm used for hashing
+    :param recheck: how many times at most is the file read again when its hash changed but its size and
+     modification time did not, see recheck_file_hash. 0 does not read it again
+    :param verbose: passed to recheck_file_hash
+    :param paranoid: when set to True, file is always hashed
+    :param copy_to: passed to get_file_hash, used only when the file is new or its stat changed
+    :param buffer_size: passed to get_file_hash
+    :param blocks: when set to True, blocks of hashed files of at least delta_file_size bytes are hashed too
+    :param stats: Stats where time and processed items are added, default_stats when not given
+    :return: tuple (file stat, hash, copied, block hashes), stat is None when file does not exist, hash is None in same
+     cases as in get_file_hash, copied is True when the file was written into copy_to, block hashes are made by
+     BlockHasher or None when the blocks were not hashed
+    """
+    if stats is None:
+        stats = default_stats
+    try:
+        file_stat = entry.stat()
+    except OSError:
+        return None, None, False, None
+    if record is not None and record[1:] == file_stat_values(file_stat):
+        if not paranoid:
+            stats.add('hashing', skipped_files=1)
+            return file_stat, record[0], False, None
+        copy_to = None  # Most likely unchanged, not worth writing
+    block_hasher = BlockHasher() if blocks and file_stat.st_size >= delta_file_size else None
+    time_hash_start = time.perf_counter()
+    try:
+        file_hash = get_file_hash(entry.path, algorithm, copy_to, buffer_size, block_hasher, file_stat)
+        stats.add('hashing', time.perf_counter() - time_hash_start, files=1, bytes=file_stat.st_size)
+        if file_hash is None or hash_algorithms[algorithm][0] is None:  # time algorithm does not read the file
+            return file_stat, file_hash, False, None
+        if recheck and record is not None and file_hash != record[0] and \
+                record[1:3] == file_stat_values(file_stat)[:2]:
+            first_hash = file_hash
+            file_hash = recheck_file_hash(entry.path, algorithm, file_hash, recheck, verbose, buffer_size,
+                                          block_hasher, stats)
+            if file_hash != first_hash and copy_to is not None:  # Copy has the data of the first read
+                os.remove(copy_to)
+                copy_to = None
+    except OSError:
+        if copy_to is not None and os.path.isfile(copy_to):
+            os.remove(copy_to)
+        raise
+    return file_stat, file_hash, copy_to is not None, block_hasher.digest() if block_hasher is not None else None
+
+
+def hash_files(files, algorithm, recheck=0, verbose=False, jobs=1, paranoid=False, copy_target=None,
+               buffer_size=None, blocks=False, stats=None):
+    """
+    Hashes files using a pool of worker threads and yields the results in the same order as the files were given,
+    so the caller can process them exactly as if they were hashed one by one. Files are hashed in the pool even with
+    one job, so the caller works on the results, like saving them to database, while the next files are hashed.
+    Files that do not have to be read because their stat did not change are resolved right away, handing them over
+    to the pool would cost more than checking them
+    :param files: iterable of (entry, record) tuples, both are passed to get_file_hash_cached
+    :param algorithm: algorithm used for hashing
+    :param recheck: passed to get_file_hash_cached
+    :param verbose: passed to get_file_hash_cached
+    :param jobs: number of files hashed at once
+    :param paranoid: passed to get_file_hash_cached
+    :param copy_target: function given the entry and record of a file that returns path where the file is copied
+     while hashing it or None to not copy it, None does not copy any file
+    :param buffer_size: passed to get_file_hash
+    :param blocks: passed to get_file_hash_cached
+    :param stats: Stats where time and processed items are added, default_stats when not given
+    :return: generator of (file path, record, file stat, hash, copied, block hashes) tuples
+    """
+    if stats is None:
+        stats = default_stats
+    # Keep only a limited number of files in flight so huge trees do not pile up futures in memory
+    max_pending = max(jobs, 1) * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for entry, record in files:
+            if not paranoid and record is not None and is_unchanged(entry, record):
+                future = Future()
+                future.set_result(get_file_hash_cached(entry, record, algorithm, stats=stats))
+            else:
+                future = executor.submit(get_file_hash_cached, entry, record, algorithm, recheck, verbose, paranoid,
+                                         copy_target(entry, record) if copy_target else None, buffer_size, blocks,
+                                         stats)
+            pending.append((entry.path, record, future))
+            if len(pending) >= max_pending:
+                file, record, future = pending.popleft()
+                yield (file, record) + future.result()
+        while pending:
+            file, record, future = pending.popleft()
+            yield (file, record) + future.result()
+
+
+def is_unchanged(entry, record):
+    """
+    :param entry: os.DirEntry of the file
+    :param record: tuple (hash, size, mtime_ns, inode) saved during previous run
+    :return: True if the file has the same size, modification time and inode as during previous run
+    """
+    try:
+        return record[1:] == file_stat_values(entry.stat())
+    except OSError:
+        return False
+
+
+def file_stat_values(file_stat):
+    """
+    Picks values from file stat that are saved into database to detect changed files without reading them
+    :param file_stat: result of os.stat
+    :return: tuple (size, mtime_ns, inode)
+    """
+    return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino
+
+
 def input_yes_no(question, default="NONE"):
     """Asks user standard yes/no question that can be answered y (yes) or n (no)
     :param question: question showed to user
@@ -452,6 +1894,1063 @@ def input_yes_no(question, default="NONE"):
             return False
 
 
+class HashDatabase:
+    """
+    SQL database with hashes. Reads are batched and writes are buffered and sent in bulk, so the scan does not pay
+    for a database round trip per file. Files found during the scan are tracked in a temporary table, so the saved
+    hashes do not have to be rewritten before every scan. The table is kept until the scan finishes, so together with
+    regular checkpoints an interrupted scan can be resumed.
+    Files are saved as a directory id and a name, directories form a tree in their own table, so long paths are not
+    repeated for every file. Hashes are saved as binary, see pack_hash. Methods take and return file paths and
+    hexadecimal hashes, the conversion is done internally.
+    One database can hold more source directories, every one is saved as a named root with its own directory tree and
+    scanned by its own connection, see MultiScanner. Everything done by a connection is limited to its root then and
+    changes are committed with every flush, so connections scanning other roots do not wait for long.
+    Full batches of buffered changes are written by a writer thread while the scan goes on. Only one batch is written
+    at once and every other use of the database waits until it is written, see sql
+    """
+    batch_size = 500  # How many files are looked up or written at once
+    schema_version = 5  # Version of tables layout, databases with older version are migrated when opened
+    directory_time_margin = 2 * 10 ** 9  # Directories modified less nanoseconds ago are listed again next time
+    lock_timeout = 600  # How many seconds is waited for other connection writing into the database
+
+    def __init__(self, path, time_start, show_info=False, root=None, read_only=False, stats=None):
+        """
+        Opens the database, creates its tables when they do not exist yet and migrates them from older versions
+        :param path: path to the database file
+        :param time_start: time of the scan start, saved to modified files
+        :param show_info: if set to True prints when the database is migrated
+        :param root: path of the source directory when the database is shared by more of them, file paths are
+         relative to it then. None uses the default root, where paths are saved as they are
+        :param read_only: if set to True, the database is only queried, like by find_hash. It is not locked nor
+         changed, so tables are neither created nor migrated and sqlite3.DatabaseError is raised when they are not
+         of the current version
+        :param stats: Stats where time spent in the database is added, default_stats when not given
+        """
+        self.time_start = time_start
+        self.stats = default_stats if stats is None else stats
+        # Connection can be closed by other thread than the one scanning, it is never used by two threads at once
+        if read_only:
+            self.connection = sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(path), uri=True,
+                                              check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(path, timeout=self.lock_timeout, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.writer = ThreadPoolExecutor(max_workers=1)  # Writes batches of changes, see _queue
+        self.writer_cursor = self.connection.cursor()
+        self.write_future = None  # Batch being written by the writer
+        self.scoped = False  # True when files looked for by the scan are limited, see limit_scan
+        self.new_root = False  # True when the root was added by this connection, so it has no files yet
+        self.root_id = 0
+        self.rooted = False
+        self.directory_ids = {'': self.root_id}  # Cache of directories, key is path, value is id
+        self.directory_paths = {self.root_id: ''}  # Key is id, value is path
+        self.full_paths = {}  # Cache of find_hash, key is directory id, value is (root path, full directory path)
+        self.pending = {'insert': [], 'update': [], 'update_stat': [], 'rename': [], 'found': [], 'directory': [],
+                        'seen': [], 'blocks': [], 'delete_blocks': []}
+        # Files marked found or renamed from since the last flush, as (directory id, name), see find_unfound
+        self.pending_found = set()
+        try:
+            if read_only:
+                try:
+                    version = self.get_info('schema_version')
+                except sqlite3.OperationalError:  # Version 1 has no info table
+                    version = None
+                if version != str(self.schema_version):
+                    raise sqlite3.DatabaseError('it is not of schema version %d, scanning into it migrates older '
+                                                'versions' % self.schema_version)
+            else:
+                self._open(show_info, root)
+        except BaseException:
+            self.close()  # Do not keep the database locked for other connections
+            raise
+
+    def _open(self, show_info, root):
+        """Creates tables, migrates them from older versions and finds the root, see __init__"""
+        self.sql.execute('PRAGMA journal_mode=WAL')
+        self.sql.execute('PRAGMA synchronous=NORMAL')
+        self.sql.execute('PRAGMA cache_size=-65536')  # 64 MiB
+        # Take the write lock right away, so connections opening the database at once wait for each other instead of
+        # failing to upgrade their read transaction
+        self.sql.execute('BEGIN IMMEDIATE')
+        self.sql.execute('CREATE TABLE IF NOT EXISTS "info" ( `key` TEXT PRIMARY KEY, `value` TEXT )')
+        version = self.get_info('schema_version')
+        has_old_table = self.sql.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='hashes'"
+                                         ).fetchone()[0] > 0
+        # Modification time and number of entries are saved for listed directories, see directory_listing
+        self.sql.execute('CREATE TABLE IF NOT EXISTS "directories" ( `id` INTEGER PRIMARY KEY, `parent` INTEGER,'
+                         ' `name` TEXT NOT NULL, `mtime_ns` INTEGER, `entries` INTEGER, UNIQUE (`parent`, `name`) )')
+        if version == '2':
+            if show_info:
+                print('Migrating database to schema version %d' % self.schema_version)
+            self.sql.execute('ALTER TABLE "directories" ADD COLUMN `mtime_ns` INTEGER')
+            self.sql.execute('ALTER TABLE "directories" ADD COLUMN `entries` INTEGER')
+        # Root of relative paths
+        self.sql.execute("INSERT OR IGNORE INTO \"directories\" (id, parent, name) VALUES (0, NULL, '')")
+        self.sql.execute('CREATE TABLE IF NOT EXISTS "files" ( `directory` INTEGER NOT NULL, `name` TEXT NOT NULL,'
+                         ' `hash` BLOB NOT NULL, `modified` INTEGER NOT NULL DEFAULT 0, `size` INTEGER,'
+                         ' `mtime_ns` INTEGER, `inode` INTEGER, PRIMARY KEY (`directory`, `name`) ) WITHOUT ROWID')
+        self.sql.execute('CREATE INDEX IF NOT EXISTS "files_hash" ON "files" (`hash`)')
+        self.sql.execute('CREATE INDEX IF NOT EXISTS "files_inode" ON "files" (`inode`)')  # See has_unfound_stat
+        # Files verified by running scan with the change found, old_directory and old_name are set for renamed files
+        self.sql.execute('CREATE TABLE IF NOT EXISTS "found" ( `directory` INTEGER NOT NULL, `name` TEXT NOT NULL,'
+                         ' `change` TEXT, `old_directory` INTEGER, `old_name` TEXT,'
+                         ' PRIMARY KEY (`directory`, `name`) ) WITHOUT ROWID')
+        # Hashes of blocks of large files made by BlockHasher, used to update only changed blocks in backup
+        self.sql.execute('CREATE TABLE IF NOT EXISTS "blocks" ( `directory` INTEGER NOT NULL, `name` TEXT NOT NULL,'
+                         ' `block_size` INTEGER NOT NULL, `hashes` BLOB NOT NULL,'
+                         ' PRIMARY KEY (`directory`, `name`) ) WITHOUT ROWID')
+        # Named roots, id is the top directory of the root. Its name is the path of the root
+        self.sql.execute('CREATE TABLE IF NOT EXISTS "roots" ( `id` INTEGER PRIMARY KEY, `path` TEXT NOT NULL UNIQUE )')
+        # Directories listed or taken from the database by running scan, others are forgotten when it finishes
+        self.sql.execute('CREATE TEMP TABLE "seen_directories" ( `id` INTEGER PRIMARY KEY )')
+        if version is None and has_old_table:  # Old databases have only the default root
+            if show_info:
+                print('Migrating database to schema version %d' % self.schema_version)
+            self._migrate_from_version_1()
+            self.sql.execute('BEGIN IMMEDIATE')
+        if root is not None:
+            row = self.sql.execute('SELECT id FROM "roots" WHERE path=?', (root,)).fetchone()
+            if row is None:
+                self.sql.execute('INSERT INTO "directories" (parent, name) VALUES (NULL, ?)', (root,))
+                row = (self.sql.lastrowid,)
+                self.sql.execute('INSERT INTO "roots" VALUES (?, ?)', (row[0], root))
+                self.new_root = True
+            self.root_id = row[0]
+        # With more roots everything is limited to directories of this one, including the default root
+        self.rooted = root is not None or self.sql.execute('SELECT COUNT(*) FROM "roots"').fetchone()[0] > 0
+        if self.rooted:
+            self.sql.execute('CREATE TEMP TABLE "root_directories" ( `id` INTEGER PRIMARY KEY )')
+            self._load_root_directories()
+        self.scan_key = 'scan_started' if root is None else 'scan_started ' + root  # Set in info while scanning
+        self.directory_ids = {'': self.root_id}
+        self.directory_paths = {self.root_id: ''}
+        self.set_info('schema_version', str(self.schema_version))
+        self.connection.commit()
+
+    @property
+    def sql(self):
+        """
+        :return: cursor of the database, available once the batch written by the writer thread is written
+        """
+        if self.write_future is not None:
+            future, self.write_future = self.write_future, None
+            future.result()  # Errors of the writer are raised here
+        return self.cursor
+
+    def _migrate_from_version_1(self):
+        """
+        Moves hashes from the single "hashes" table with full paths and hexadecimal hashes into the current tables
+        """
+        columns = [row[1] for row in self.sql.execute('PRAGMA table_info("hashes")').fetchall()]
+        stat_columns = ', '.join(column if column in columns else 'NULL' for column in ('size', 'mtime_ns', 'inode'))
+        rows = self.connection.cursor().execute('SELECT file, hash, modified, %s FROM hashes' % stat_columns)
+        while True:
+            chunk = rows.fetchmany(self.batch_size)
+            if not chunk:
+                break
+            self.sql.executemany('INSERT INTO "files" VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 [self._split_file(row[0], True) + (pack_hash(row[1]),) + row[2:] for row in chunk])
+        self.sql.execute('DROP TABLE "hashes"')
+        self.set_info('schema_version', str(self.schema_version))
+        self.connection.commit()
+        self.sql.execute('VACUUM')  # Give the space of the old table back
+
+    def _directory_id(self, path, create=False):
+        """
+        Finds id of a directory
+        :param path: path of the directory, as used in saved file paths
+        :param create: when True, missing directories are created
+        :return: id of the directory or None when it does not exist
+        """
+        # Walk up to the nearest known directory, then resolve the missing ones top down
+        missing = []
+        while path not in self.directory_ids:
+            head, tail = os.path.split(path)
+            if head == path:  # Root of absolute paths, like /
+                head, tail = None, path
+            missing.append((path, tail))
+            if head is None:
+                break
+            path = head
+        parent_id = self.directory_ids.get(path) if missing and missing[-1][0] != path else None
+        for directory_path, name in reversed(missing):
+            row = self.sql.execute('SELECT id FROM "directories" WHERE parent IS ? AND name=?',
+                                   (parent_id, name)).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                self.sql.execute('INSERT INTO "directories" (parent, name) VALUES (?, ?)', (parent_id, name))
+                row = (self.sql.lastrowid,)
+                if self.rooted:
+                    self.sql.execute('INSERT INTO "root_directories" VALUES (?)', row)
+                    self.connection.commit()  # Do not keep other roots waiting until the next flush
+            parent_id = row[0]
+            self.directory_ids[directory_path] = parent_id
+            self.directory_paths[parent_id] = directory_path
+        return self.directory_ids[missing[0][0] if missing else path]
+
+    def _directory_path(self, directory_id):
+        """
+        :param directory_id: id of a saved directory
+        :return: path of the directory
+        """
+        missing = []
+        while directory_id not in self.directory_paths:
+            parent_id, name = self.sql.execute('SELECT parent, name FROM "directories" WHERE id=?',
+                                               (directory_id,)).fetchone()
+            missing.append((directory_id, name))
+            if parent_id is None:
+                break
+            directory_id = parent_id
+        path = self.directory_paths.get(directory_id) if missing and missing[-1][0] != directory_id else None
+        for missing_id, name in reversed(missing):
+            path = name if path is None else os.path.join(path, name)
+            self.directory_paths[missing_id] = path
+            self.directory_ids[path] = missing_id
+        return self.directory_paths[missing[0][0] if missing else directory_id]
+
+    def _split_file(self, file, create=False):
+        """
+        Converts file path into tuple (directory id, name), directory id is None when it is not saved and create
+        is False
+        """
+        head, tail = os.path.split(file)
+        return self._directory_id(head, create), tail
+
+    def _join_file(self, directory_id, name):
+        """Converts saved directory id and name to file path"""
+        return os.path.join(self._directory_path(directory_id), name)
+
+    def get_info(self, key):
+        """
+        :param key: name of the value saved with hashes, like algorithm
+        :return: saved value or None
+        """
+        row = self.sql.execute('SELECT value FROM "info" WHERE key=?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_info(self, key, value):
+        """
+        Saves a value with hashes
+        :param key: name of the value, like algorithm
+        :param value: text to be saved
+        """
+        self.sql.execute('INSERT OR REPLACE INTO "info" VALUES (?, ?)', (key, value))
+
+    def count(self):
+        """
+        :return: number of saved hashes
+        """
+        return self.sql.execute('SELECT COUNT(*) FROM "files" WHERE 1' + self._scope('directory')).fetchone()[0]
+
+    def roots(self):
+        """
+        :return: list of paths of named roots
+        """
+        return [row[0] for row in self.sql.execute('SELECT path FROM "roots" ORDER BY path').fetchall()]
+
+    def _full_path(self, directory_id):
+        """
+        :param directory_id: id of any saved directory, in any root
+        :return: tuple (path of the named root or empty string, path of the directory including path of the root)
+        """
+        names = []
+        top_id = directory_id
+        while top_id not in self.full_paths:
+            parent_id, name = self.sql.execute('SELECT parent, name FROM "directories" WHERE id=?',
+                                               (top_id,)).fetchone()
+            if parent_id is None:
+                is_root = self.sql.execute('SELECT 1 FROM "roots" WHERE id=?', (top_id,)).fetchone() is not None
+                self.full_paths[top_id] = (name if is_root else '', name)
+                break
+            names.append(name)
+            top_id = parent_id
+        root, path = self.full_paths[top_id]
+        if names:
+            path = os.path.join(path, *reversed(names))
+            self.full_paths[directory_id] = (root, path)
+        return root, path
+
+    def find_hash(self, file_hash):
+        """
+        Looks for files with given hash in all roots
+        :param file_hash: hash of the file
+        :return: list of tuples (root path, file path including the root path), root path is an empty string for
+         files saved without named root
+        """
+        files = []
+        for directory_id, name in self.sql.execute('SELECT directory, name FROM "files" WHERE hash=?',
+                                                   (pack_hash(file_hash),)).fetchall():
+            root, path = self._full_path(directory_id)
+            files.append((root, os.path.join(path, name)))
+        return files
+
+    def duplicates(self, across_roots=True):
+        """
+        Finds files with the same content
+        :param across_roots: if set to True, only contents saved in more roots are returned
+        :return: generator of tuples (hash, list of files as returned by find_hash)
+        """
+        for packed_hash, in self.connection.cursor().execute('SELECT hash FROM "files" GROUP BY hash '
+                                                              'HAVING COUNT(*) > 1'):
+            file_hash = unpack_hash(packed_hash)
+            files = self.find_hash(file_hash)
+            if not across_roots or len(set(root for root, _ in files)) > 1:
+                yield file_hash, files
+
+    def lookup(self, files):
+        """
+        Loads saved records of given files
+        :param files: list of file names
+        :return: dictionary, key is file name, value is tuple (hash, size, mtime_ns, inode)
+        """
+        time_start = time.perf_counter()
+        records = {file: (unpack_hash(row[0]),) + row[1:]
+                   for file, row in self._select_files(files, 'files', 'hash, size, mtime_ns, inode')}
+        self.stats.add('database', time.perf_counter() - time_start, lookups=len(files))
+        return records
+
+    def _select_files(self, files, table, columns):
+        """
+        Selects rows of given files from a table keyed by directory and name
+        :param files: list of file names
+        :param table: name of the table
+        :param columns: selected columns
+        :return: list of (file name, tuple of selected values) for files that have a row
+        """
+        # Listed files come directory by directory, so they are looked up by directories
+        directories = {}  # Key is directory id, value is list of names
+        for file in files:
+            directory_id, name = self._split_file(file)
+            if directory_id is not None:
+                directories.setdefault(directory_id, []).append(name)
+        rows = []
+        for directory_id, names in directories.items():
+            for i in range(0, len(names), self.batch_size):
+                chunk = names[i:i + self.batch_size]
+                for row in self.sql.execute('SELECT name, %s FROM "%s" WHERE directory=? AND name IN (%s)' %
+                                            (columns, table, ','.join('?' * len(chunk))),
+                                            [directory_id] + chunk).fetchall():
+                    rows.append((self._join_file(directory_id, row[0]), row[1:]))
+        return rows
+
+    def begin_scan(self, resume=False, time_start=None):
+        """
+        Starts a scan. When previous scan was interrupted, its changes are returned. Files it verified stay found when
+        resuming, otherwise they are forgotten and will be verified again
+        :param resume: if set to True, interrupted scan is continued
+        :param time_start: time of the scan start, saved to modified files. By default the time given when the
+         database was opened
+        :return: list of (change, file, file before renaming) found by interrupted scan or None when no scan was
+         interrupted
+        """
+        changes = None
+        self.scoped = False
+        if self.rooted:  # Ids of directories deleted by previous scan may be used by other roots now
+            self._load_root_directories()
+        if self.get_info(self.scan_key) is not None:
+            rows = self.sql.execute('SELECT change, directory, name, old_directory, old_name FROM "found" '
+                                    'WHERE change IS NOT NULL' + self._scope('directory')).fetchall()
+            changes = [(row[0], self._join_file(row[1], row[2]),
+                        self._join_file(row[3], row[4]) if row[3] is not None else None) for row in rows]
+            if not resume:
+                self.sql.execute('DELETE FROM "found" WHERE 1' + self._scope('directory'))
+        if time_start is not None:
+            self.time_start = time_start
+        self.sql.execute('DELETE FROM "seen_directories"')  # Left by previous scan when the database is reused
+        self.set_info(self.scan_key, str(self.time_start))
+        self.connection.commit()
+        return changes
+
+    def _load_root_directories(self):
+        """Finds all directories of the root, see _scope"""
+        self.sql.execute('DELETE FROM "root_directories"')
+        self.sql.execute('WITH RECURSIVE tree(id) AS (SELECT ? UNION SELECT directories.id FROM "directories" '
+                         'JOIN tree ON directories.parent=tree.id) INSERT INTO "root_directories" '
+                         'SELECT id FROM tree', (self.root_id,))
+
+    def limit_scan(self, directories, trees):
+        """
+        Limits running scan to some directories. Only saved files in them can be found as deleted or renamed, files
+        elsewhere are left as they are
+        :param directories: paths of directories whose files are scanned, as used in saved file paths
+        :param trees: paths of directories scanned together with all their subdirectories
+        """
+        self.sql.execute('CREATE TEMP TABLE IF NOT EXISTS "scope" ( `id` INTEGER PRIMARY KEY )')
+        self.sql.execute('DELETE FROM "scope"')
+        directory_ids = [self._directory_id(directory) for directory in directories]
+        self.sql.executemany('INSERT OR IGNORE INTO "scope" VALUES (?)',
+                             [(directory_id,) for directory_id in directory_ids if directory_id is not None])
+        for tree in trees:
+            tree_id = self._directory_id(tree)
+            if tree_id is not None:
+                self.sql.execute('WITH RECURSIVE tree(id) AS (SELECT ? UNION SELECT directories.id FROM "directories" '
+                                 'JOIN tree ON directories.parent=tree.id) INSERT OR IGNORE INTO "scope" '
+                                 'SELECT id FROM tree', (tree_id,))
+        self.scoped = True
+
+    def _scope(self, column):
+        """
+        :param column: column with directory id
+        :return: SQL condition limiting rows to directories scanned by limited scan or to directories of the root when
+         there are more roots, empty when the scan is not limited
+        """
+        if self.scoped:  # Scope is always inside the root
+            return ' AND %s IN (SELECT id FROM "scope")' % column
+        return self._root_scope(column)
+
+    def _root_scope(self, column):
+        """
+        :param column: column with directory id
+        :return: SQL condition limiting rows to directories of the root when there are more roots, otherwise empty
+        """
+        return ' AND %s IN (SELECT id FROM "root_directories")' % column if self.rooted else ''
+
+    def lookup_done(self, files):
+        """
+        Looks for files already verified by this scan, including the part done before it was interrupted
+        :param files: list of file names
+        :return: set of verified file names
+        """
+        return set(file for file, _ in self._select_files(files, 'found', '1'))
+
+    def mark_found(self, file, change=None, old_file=None):
+        """
+        Marks file as present on the disk and verified, files that are not marked are deleted by delete_unfound
+        :param file: file name
+        :param change: change found on the file: new, modified, renamed, indexed or None when the file is the same
+        :param old_file: name of the file before renaming
+        """
+        old_directory, old_name = self._split_file(old_file, True) if old_file is not None else (None, None)
+        directory_id, name = self._split_file(file, True)
+        self.pending_found.add((directory_id, name))
+        self._queue('found', (directory_id, name, change, old_directory, old_name))
+
+    def find_unfound(self, file_hash):
+        """
+        Looks for saved files with given hash that were not found during this scan yet
+        :param file_hash: hash of the file
+        :return: list of at most 2 file names, more are not needed to tell if the file is unique
+        """
+        # Called for every new file, so buffered changes are not written, files found since the last flush are skipped
+        self.sql  # Wait for the batch being written
+        files = []
+        for row in self.connection.cursor().execute(
+                'SELECT directory, name FROM "files" WHERE hash=? AND NOT EXISTS (SELECT 1 FROM "found" WHERE '
+                'found.directory=files.directory AND found.name=files.name)' + self._scope('directory'),
+                (pack_hash(file_hash),)):
+            if row not in self.pending_found:
+                files.append(self._join_file(*row))
+                if len(files) == 2:
+                    break
+        return files
+
+    def has_unfound_stat(self, size, inode):
+        """
+        Looks for saved file with given size and inode that was not found during this scan yet, like a renamed file
+        :param size: size of the file
+        :param inode: inode of the file
+        :return: True when such file is saved
+        """
+        return self.sql.execute(
+            'SELECT 1 FROM "files" WHERE inode=? AND size=? AND NOT EXISTS (SELECT 1 FROM "found" WHERE '
+            'found.directory=files.directory AND found.name=files.name)' + self._scope('directory') + ' LIMIT 1',
+            (inode, size)).fetchone() is not None
+
+    def directory_listing(self, directory, directory_stat):
+        """
+        Loads names of files and subdirectories saved in a directory, when it did not change since it was listed
+        :param directory: path of the directory, as used in saved file paths
+        :param directory_stat: current stat of the directory
+        :return: tuple (list of file names, list of directory names) or None when the directory changed or not all of
+         its entries are saved, like files that could not be hashed
+        """
+        directory_id = self._directory_id(directory)
+        if directory_id is None:
+            return None
+        mtime_ns, entries = self.sql.execute('SELECT mtime_ns, entries FROM "directories" WHERE id=?',
+                                             (directory_id,)).fetchone()
+        if mtime_ns is None or mtime_ns != directory_stat.st_mtime_ns:
+            return None
+        file_names = [row[0] for row in self.sql.execute('SELECT name FROM "files" WHERE directory=?',
+                                                         (directory_id,)).fetchall()]
+        directory_names = [row[0] for row in self.sql.execute('SELECT name FROM "directories" WHERE parent=?',
+                                                              (directory_id,)).fetchall()]
+        if len(file_names) + len(directory_names) != entries:
+            return None
+        self._queue('seen', (directory_id,))
+        return file_names, directory_names
+
+    def lookup_blocks(self, file):
+        """
+        :param file: file name
+        :return: tuple (block size, block hashes) saved for the file or None
+        """
+        directory_id, name = self._split_file(file)
+        return self.sql.execute('SELECT block_size, hashes FROM "blocks" WHERE directory=? AND name=?',
+                                (directory_id, name)).fetchone()
+
+    def save_blocks(self, file, block_hashes):
+        """
+        Saves hashes of blocks of a file made by BlockHasher
+        :param file: file name
+        :param block_hashes: hashes of blocks or None to forget saved ones
+        """
+        if block_hashes is None:
+            self._queue('delete_blocks', self._split_file(file, True))
+        else:
+            self._queue('blocks', self._split_file(file, True) + (delta_block_size, block_hashes))
+
+    def save_directory(self, directory, directory_stat, entries):
+        """
+        Saves modification time and number of entries of a listed directory, see directory_listing
+        :param directory: path of the directory, as used in saved file paths
+        :param directory_stat: stat of the directory taken before it was listed
+        :param entries: number of all entries in the directory
+        """
+        directory_id = self._directory_id(directory, True)
+        mtime_ns = directory_stat.st_mtime_ns
+        # Changes done right after listing may not change the time on file systems with coarse timestamps
+        if int(time.time() * 10 ** 9) - mtime_ns < self.directory_time_margin:
+            mtime_ns = None
+        self._queue('directory', (mtime_ns, entries, directory_id))
+        self._queue('seen', (directory_id,))
+
+    def insert(self, file, file_hash, file_stat):
+        """Saves hash of a new file"""
+        self._queue('insert', self._split_file(file, True) + (pack_hash(file_hash), self.time_start) +
+                    file_stat_values(file_stat))
+
+    def update(self, file, file_hash, file_stat, modified=True):
+        """
+        Saves new hash and stat of a file
+        :param modified: when False, only stat is saved and the file is not marked as modified
+        """
+        if modified:
+            self._queue('update', (pack_hash(file_hash), self.time_start) + file_stat_values(file_stat) +
+                        self._split_file(file, True))
+        else:
+            self._queue('update_stat', file_stat_values(file_stat) + self._split_file(file, True))
+
+    def rename(self, old_file, new_file, file_stat):
+        """Moves saved hash from old file name to the new one"""
+        old_directory_file = self._split_file(old_file, True)
+        self.pending_found.add(old_directory_file)  # Still saved under the old name until flushed
+        self._queue('rename', self._split_file(new_file, True) + (self.time_start,) + file_stat_values(file_stat) +
+                    old_directory_file)
+
+    def _queue(self, operation, values):
+        self.pending[operation].append(values)
+        if len(self.pending[operation]) >= self.batch_size:
+            pending = self._take_pending()
+            self.sql  # Wait for the previous batch
+            self.write_future = self.writer.submit(self._write, pending, self.writer_cursor)
+
+    def _take_pending(self):
+        """
+        :return: buffered changes, buffers are emptied
+        """
+        pending, self.pending = self.pending, {operation: [] for operation in self.pending}
+        self.pending_found = set()  # Found in the database once the changes are written
+        return pending
+
+    def flush(self):
+        """Writes all buffered changes into the database"""
+        self._write(self._take_pending(), self.sql)
+
+    def _write(self, pending, cursor):
+        """
+        Writes buffered changes into the database. With more roots, they are committed, so connections scanning other
+        roots do not wait for long
+        :param pending: changes as buffered in self.pending
+        :param cursor: cursor used for writing, every thread uses its own
+        """
+        time_start = time.perf_counter()
+        writes = sum(len(values) for values in pending.values())
+        # Renames go first, a new file can be saved under the old name of a renamed one in the same batch
+        statements = [
+            ('UPDATE "files" SET directory=?, name=?, modified=?, size=?, mtime_ns=?, inode=? '
+             'WHERE directory=? AND name=?', pending['rename']),
+            ('UPDATE "blocks" SET directory=?, name=? WHERE directory=? AND name=?',
+             [values[:2] + values[-2:] for values in pending['rename']]),
+            ('INSERT INTO "files" (directory, name, hash, modified, size, mtime_ns, inode) '
+             'VALUES (?, ?, ?, ?, ?, ?, ?)', pending['insert']),
+            ('UPDATE "files" SET hash=?, modified=?, size=?, mtime_ns=?, inode=? WHERE directory=? AND name=?',
+             pending['update']),
+            ('UPDATE "files" SET size=?, mtime_ns=?, inode=? WHERE directory=? AND name=?', pending['update_stat']),
+            ('INSERT OR REPLACE INTO "blocks" VALUES (?, ?, ?, ?)', pending['blocks']),
+            ('DELETE FROM "blocks" WHERE directory=? AND name=?', pending['delete_blocks']),
+            ('INSERT OR REPLACE INTO "found" VALUES (?, ?, ?, ?, ?)', pending['found']),
+            ('UPDATE "directories" SET mtime_ns=?, entries=? WHERE id=?', pending['directory']),
+            ('INSERT OR IGNORE INTO "seen_directories" VALUES (?)', pending['seen']),
+        ]
+        for statement, values in statements:
+            if values:
+                cursor.executemany(statement, values)
+        if self.rooted:
+            self.connection.commit()
+        self.stats.add('database', time.perf_counter() - time_start, writes=writes)
+
+    def delete_unfound(self):
+        """
+        Deletes hashes of files that were not found during this scan
+        :return: list of deleted file names
+        """
+        self.flush()
+        unfound = 'NOT EXISTS (SELECT 1 FROM "found" WHERE found.directory=files.directory AND found.name=files.name)'
+        unfound += self._scope('directory')
+        deleted_files = [self._join_file(*row) for row in
+                         self.sql.execute('SELECT directory, name FROM "files" WHERE ' + unfound).fetchall()]
+        self.sql.execute('DELETE FROM "files" WHERE ' + unfound)
+        self.sql.execute('DELETE FROM "blocks" WHERE NOT EXISTS (SELECT 1 FROM "files" WHERE '
+                         'files.directory=blocks.directory AND files.name=blocks.name)' + self._scope('directory'))
+        # Forget directories that were not seen and have no files, unless they are parents of the kept ones
+        self.sql.execute('WITH RECURSIVE kept(id) AS (SELECT id FROM "seen_directories" UNION '
+                         'SELECT directory FROM "files" UNION SELECT parent FROM "directories" JOIN kept '
+                         'ON directories.id=kept.id WHERE parent IS NOT NULL) '
+                         'DELETE FROM "directories" WHERE id != ? AND id NOT IN kept' + self._scope('id'),
+                         (self.root_id,))
+        self.directory_ids = {'': self.root_id}
+        self.directory_paths = {self.root_id: ''}
+        return deleted_files
+
+    def checkpoint(self):
+        """Saves all changes done so far, scan can be resumed from here when interrupted"""
+        self.flush()  # Waits for the writer too
+        time_start = time.perf_counter()
+        self.connection.commit()
+        self.stats.add('database', time.perf_counter() - time_start, commits=1)
+
+    def finish_scan(self):
+        """Saves all changes and marks the scan as finished, the database can be used by another scan"""
+        self.flush()
+        # Directories created by limited scan are not in its scope
+        self.sql.execute('DELETE FROM "found" WHERE 1' + self._root_scope('directory'))
+        self.sql.execute('DELETE FROM "info" WHERE key=?', (self.scan_key,))
+        time_start = time.perf_counter()
+        self.connection.commit()
+        self.stats.add('database', time.perf_counter() - time_start, commits=1)
+
+    def close(self):
+        """Closes the database, changes not saved by checkpoint or finish_scan are lost like when interrupted"""
+        self.writer.shutdown()  # Waits for the batch being written, its errors do not matter anymore
+        self.connection.close()
+
+
+class ContentStore:
+    """
+    Backup directory where every unique content is saved only once. Files are saved under their hashes in objects
+    directory, tree directory mirrors the source directory with hard links to the objects and manifest lists hash of
+    every backed up file, so the tree can be restored from it where hard links cannot be made. Objects are read only,
+    as changing a file in the tree changes all files with the same content
+    """
+
+    def __init__(self, path, algorithm):
+        """
+        Opens the store, loads its manifest
+        :param path: directory of the store, ending with separator
+        :param algorithm: algorithm used for new stores, opened store keeps its own
+        """
+        self.objects_dir = path + 'objects' + os.sep
+        self.tree_dir = path + 'tree' + os.sep
+        self.manifest_path = path + 'manifest.txt'
+        self.algorithm = algorithm
+        self.manifest = {}  # Key is file name, value is its hash
+        self.hard_links = True  # False when the file system cannot make hard links, only manifest is kept then
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'rt') as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line.startswith('#pSync algorithm='):
+                        self.algorithm = line[len('#pSync algorithm='):]
+                    elif line:
+                        file_hash, file = line.split(' ', 1)
+                        self.manifest[file] = file_hash
+
+    def object_name(self, file_hash):
+        """
+        :return: path of the object with given hash relative to objects directory
+        """
+        return os.path.join(file_hash[:2], file_hash[2:])
+
+    def update(self, stored_files, renamed_files, deleted_files, source_dir, jobs=1, verbose=False,
+               show_progress=False, stats=None):
+        """
+        Saves changes found by the scan. Contents that are not stored yet are copied, objects no longer used by any
+        file are deleted
+        :param stored_files: dictionary, key is name of new or modified file, value is its hash or None when it is not
+         known and the file has to be hashed again
+        :param renamed_files: dictionary, key is file name before renaming, value is its new name
+        :param deleted_files: list of deleted file names
+        :param source_dir: directory with the files
+        :param jobs: number of files copied at once
+        :param verbose: if set to true prints every stored, linked and deleted file
+        :param show_progress: passed to copy_files
+        :param stats: passed to copy_files and delete_files
+        """
+        stored_files = dict(stored_files)
+        replaced_hashes = set()  # Hashes of files that were deleted or changed, their objects may not be needed
+        for old_file, new_file in renamed_files.items():
+            file_hash = self.manifest.pop(old_file, None)
+            if file_hash is None or new_file in stored_files:
+                stored_files.setdefault(new_file, None)
+                replaced_hashes.add(file_hash)
+                deleted_files = list(deleted_files) + [old_file]
+                continue
+            replaced_hashes.add(self.manifest.get(new_file))
+            self.manifest[new_file] = file_hash
+            if self.hard_links:
+                for file in rename_target_files({old_file: new_file}, self.tree_dir, verbose, stats):
+                    stored_files[file] = file_hash
+        for file in deleted_files:
+            replaced_hashes.add(self.manifest.pop(file, None))
+        if self.hard_links:
+            delete_files(deleted_files, self.tree_dir, jobs, verbose, stats)
+
+        # Copy every missing content once
+        objects_to_copy = {}  # Key is file name, value is name of its object
+        copied_objects = set()
+        for file, file_hash in list(stored_files.items()):
+            if file_hash is None:
+                file_hash = stored_files[file] = get_file_hash(source_dir + file, self.algorithm)
+                if file_hash is None:  # Deleted in the meantime
+                    del stored_files[file]
+                    continue
+            replaced_hashes.add(self.manifest.get(file))
+            self.manifest[file] = file_hash
+            object_name = self.object_name(file_hash)
+            if object_name not in copied_objects and not os.path.isfile(self.objects_dir + object_name):
+                objects_to_copy[file] = object_name
+                copied_objects.add(object_name)
+        copy_files(list(objects_to_copy), source_dir, self.objects_dir, jobs, verbose, show_progress, objects_to_copy,
+                   stats=stats)
+        for object_name in objects_to_copy.values():
+            object_path = self.objects_dir + object_name
+            if os.path.isfile(object_path):
+                os.chmod(object_path, stat.S_IMODE(os.stat(object_path).st_mode) & ~0o222)
+
+        for file, file_hash in stored_files.items():
+            if not os.path.isfile(self.objects_dir + self.object_name(file_hash)):  # Deleted before it was copied
+                del self.manifest[file]
+            elif self.hard_links:
+                self._link(file, file_hash, verbose)
+
+        # Forget contents of deleted and changed files, unless other files have them too
+        used_hashes = set(self.manifest.values())
+        for file_hash in replaced_hashes:
+            if file_hash is not None and file_hash not in used_hashes:
+                object_path = self.objects_dir + self.object_name(file_hash)
+                if os.path.isfile(object_path):
+                    os.remove(object_path)
+                    if verbose:
+                        print('Deleted unused "%s"' % object_path)
+                    try:
+                        os.rmdir(os.path.dirname(object_path))
+                    except OSError:  # Other objects starting with the same characters are still stored
+                        pass
+        self._save_manifest()
+
+    def _link(self, file, file_hash, verbose=False):
+        """Makes file in the tree a hard link to the object with its content"""
+        object_path = self.objects_dir + self.object_name(file_hash)
+        target_file = self.tree_dir + file
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        try:
+            os.link(object_path, target_file + temp_file_suffix)
+        except FileExistsError:
+            os.remove(target_file + temp_file_suffix)
+            os.link(object_path, target_file + temp_file_suffix)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                print('Warning: cannot make hard links in "%s" (%s), only manifest will be kept' %
+                      (self.tree_dir, e.strerror))
+                self.hard_links = False
+                return
+            copy_file(object_path, target_file)  # Object has too many links, the file gets its own copy
+            return
+        os.replace(target_file + temp_file_suffix, target_file)
+        if verbose:
+            print('Linked "%s" to "%s"' % (target_file, object_path))
+
+    def _save_manifest(self):
+        """Writes manifest into a temporary file first, so it is never left half written"""
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        with open(self.manifest_path + '_tmp', 'wt') as f:
+            f.write('#pSync algorithm=%s\n' % self.algorithm)
+            for file, file_hash in self.manifest.items():
+                f.write(file_hash + ' ' + file + '\n')
+        os.replace(self.manifest_path + '_tmp', self.manifest_path)
+
+
+class FileEntry:
+    """
+    Stands in for os.DirEntry when a single file is listed or when entries of a directory are not listed but taken
+    from DirectoryListingCache
+    """
+
+    def __init__(self, path, directory=False):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.directory = directory
+
+    def is_dir(self):
+        return self.directory
+
+    def is_file(self):
+        return not self.directory
+
+    @staticmethod
+    def is_symlink():
+        return False
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+class DirectoryListingCache:
+    """
+    Keeps modification times of listed directories in HashDatabase, so list_files can take entries of directories
+    that did not change from the database instead of listing them again. Modification time of a directory changes
+    only when its entries are added, removed or renamed, so files are still checked one by one by their stat
+    """
+
+    def __init__(self, database, source_dir, relative_file_names, reuse=True):
+        """
+        :param database: HashDatabase where listings are saved
+        :param source_dir: listed directory, ending with separator
+        :param relative_file_names: True when paths are saved relative to source_dir
+        :param reuse: if set to False, all directories are listed again, their listings are only saved
+        """
+        self.database = database
+        self.source_dir = source_dir
+        self.relative_file_names = relative_file_names
+        self.reuse = reuse
+
+    def _name(self, path):
+        """Converts path of listed directory to the path used in database"""
+        if self.relative_file_names:
+            return path[len(self.source_dir):]
+        return path.rstrip(os.sep) or os.sep
+
+    def get(self, path, directory_stat):
+        """
+        :param path: path of the directory
+        :param directory_stat: current stat of the directory
+        :return: tuple (list of file names, list of directory names) or None when the directory has to be listed
+        """
+        if not self.reuse:
+            return None
+        return self.database.directory_listing(self._name(path), directory_stat)
+
+    def put(self, path, directory_stat, entries_count):
+        """
+        Saves listed directory
+        :param path: path of the directory
+        :param directory_stat: stat of the directory taken before it was listed
+        :param entries_count: number of all entries found in the directory
+        """
+        self.database.save_directory(self._name(path), directory_stat, entries_count)
+
+
+class DirectoryWatcher:
+    """
+    Watches directory and all its subdirectories for changes using inotify. When inotify is not available, changes
+    are not known and the whole directory is scanned every watch_poll_interval seconds
+    """
+    # Flags from <sys/inotify.h>
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    watched_events = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+    def __init__(self, directory, show_info=False):
+        """
+        Starts watching
+        :param directory: watched directory
+        :param show_info: if set to True prints when inotify cannot be used
+        """
+        self.directory = directory.rstrip(os.sep) or os.sep
+        self.show_info = show_info
+        self.watches = {}  # Key is watch descriptor, value is path of watched directory
+        self.changed_directories = set()  # Directories where a file changed
+        self.changed_trees = set()  # Directories that were created, deleted or moved, with all their subdirectories
+        self.overflow = False  # True when some changes were lost, so everything has to be scanned
+        self.inotify = None  # Descriptor of inotify instance or None when changes are polled
+        libc_name = ctypes.util.find_library('c') if sys.platform.startswith('linux') else None
+        if libc_name is not None:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.inotify = self.libc.inotify_init1(os.O_CLOEXEC)
+            if self.inotify < 0:
+                self.inotify = None
+            else:
+                self._watch_tree(self.directory)
+        if self.inotify is None and show_info:
+            print('Warning: inotify is not available, directory will be scanned every %d seconds' %
+                  watch_poll_interval)
+
+    def _watch_tree(self, directory):
+        """Starts watching directory and its subdirectories, falls back to polling when it fails"""
+        for path in itertools.chain([directory], (entry.path for entry in list_files(directory, files=False))):
+            watch = self.libc.inotify_add_watch(self.inotify, os.fsencode(path), self.watched_events)
+            if watch >= 0:
+                self.watches[watch] = path
+            elif ctypes.get_errno() not in (errno.ENOENT, errno.ENOTDIR):  # Not just deleted in the meantime
+                if self.show_info:
+                    print('Warning: cannot watch "%s" (%s), directory will be scanned every %d seconds' %
+                          (path, os.strerror(ctypes.get_errno()), watch_poll_interval))
+                os.close(self.inotify)
+                self.inotify = None
+                return
+
+    def _read_events(self):
+        """Reads waiting events and remembers changed directories"""
+        data = os.read(self.inotify, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            directory = self.watches.get(watch)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:  # Directory was deleted
+                del self.watches[watch]
+                continue
+            self.changed_directories.add(directory)
+            if mask & self.IN_ISDIR and name:
+                path = os.path.join(directory, name)
+                self.changed_trees.add(path)
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._watch_tree(path)
+                    if self.inotify is None:
+                        return
+
+    def wait(self):
+        """
+        Waits until something changes and then until nothing changes for watch_debounce seconds
+        :return: tuple (list of changed directories, list of changed directory trees), only files directly in changed
+         directories and files anywhere in changed trees have to be scanned. None when everything has to be scanned
+        """
+        if self.inotify is None:
+            time.sleep(watch_poll_interval)
+            return None
+        select.select([self.inotify], [], [])
+        time_first_change = time.perf_counter()
+        while self.inotify is not None and time.perf_counter() - time_first_change < watch_max_delay and \
+                select.select([self.inotify], [], [], watch_debounce)[0]:
+            self._read_events()
+        if self.inotify is None or self.overflow:
+            self.overflow = False
+            self.changed_directories.clear()
+            self.changed_trees.clear()
+            return None
+        # Trees contain everything inside them, so directories and trees inside other trees are not needed
+        def in_changed_tree(path):
+            while True:
+                head = os.path.dirname(path)
+                if head == path:
+                    return False
+                if head in self.changed_trees:
+                    return True
+                path = head
+
+        trees = [tree for tree in self.changed_trees if not in_changed_tree(tree)]
+        directories = [directory for directory in self.changed_directories
+                       if directory not in self.changed_trees and not in_changed_tree(directory)]
+        self.changed_directories.clear()
+        self.changed_trees.clear()
+        return directories, trees
+
+    def close(self):
+        """Stops watching"""
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+
+
+class Stats:
+    """
+    Counters and timers of phases of the run, like listing, hashing or copying, reported by --stats-json. Can be
+    updated from more threads at once. Time of phases done by more threads at once, like hashing, is the sum of time
+    spent by all of them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}  # Key is name of the phase, value is dictionary with seconds and counters
+
+    def reset(self):
+        """Forgets everything, so a new run can be measured"""
+        with self.lock:
+            self.phases = {}
+
+    def add(self, phase, seconds=0.0, **counters):
+        """
+        Adds time spent in a phase and numbers of processed items
+        :param phase: name of the phase
+        :param seconds: time spent
+        :param counters: numbers of items, like files or bytes
+        """
+        with self.lock:
+            values = self.phases.setdefault(phase, {'seconds': 0.0})
+            values['seconds'] += seconds
+            for name, count in counters.items():
+                values[name] = values.get(name, 0) + count
+
+    def get(self, phase, name):
+        """
+        :return: value of a counter or 0 when nothing was counted
+        """
+        with self.lock:
+            return self.phases.get(phase, {}).get(name, 0)
+
+    def timed(self, phase, iterable):
+        """
+        Measures time spent by producing items of iterable, like listing files
+        :param phase: name of the phase
+        :param iterable: measured iterable
+        :return: generator of items of the iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            time_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - time_start)
+                return
+            self.add(phase, time.perf_counter() - time_start)
+            yield item
+
+    def report(self):
+        """
+        :return: dictionary, key is name of the phase, value is dictionary with seconds, counters and speeds of files
+         and bytes per second
+        """
+        with self.lock:
+            report = {}
+            for phase, values in self.phases.items():
+                report[phase] = dict(values)
+                for name in ('files', 'bytes'):
+                    if name in values and values['seconds'] > 0:
+                        report[phase][name + '_per_second'] = values[name] / values['seconds']
+            return report
+
+
+default_stats = Stats()  # Stats of functions called without their own, scanners have their own, see Scanner
+
+
 class Params:
     """
     Class that stores and formats parameters passed to the script
@@ -488,6 +2987,15 @@ class Params:
             return Params.sys_args_dict[param_name]
         return None
 
+    @staticmethod
+    def get_params(param_name):
+        """Finds all values of a parameter given more times
+        :param param_name name of the parameter
+        :return list of assigned values
+        """
+        return [value for name, value in zip(Params.sys_args, Params.sys_args[1:])
+                if name == param_name and not value.startswith('-')]
+
     @staticmethod
     def get_file():
         """
@@ -0,0 +1,456 @@
+"""
+Regression tests of pSync scans. Run by python -m unittest discover tests
+"""
+import contextlib
+import hashlib
+import io
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pSync
+
+
+class ScanTestCase(unittest.TestCase):
+    """Scans a temporary source directory through the library API"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='pSync_test_')
+        self.source_dir = os.path.join(self.work_dir, 'src')
+        os.mkdir(self.source_dir)
+        self.hash_file = os.path.join(self.work_dir, 'hashes.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write(self, name, content):
+        path = os.path.join(self.source_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wt') as f:
+            f.write(content)
+
+    def move(self, old_name, new_name):
+        os.rename(os.path.join(self.source_dir, old_name), os.path.join(self.source_dir, new_name))
+
+    def scan(self, sync=False, **settings):
+        """
+        Scans the source directory
+        :param sync: if set to True, found changes are applied to the backup too
+        :param settings: passed to Config
+        :return: list of changes as printed, unchanged files are left out
+        """
+        settings.setdefault('hash_file', self.hash_file)
+        engine = pSync.SyncEngine(pSync.Config(self.source_dir, **settings))
+        try:
+            return [str(change) for change in (engine.run() if sync else engine.scan())
+                    if change.kind != pSync.Change.OK]
+        finally:
+            engine.close()
+
+
+class ReadFileTest(ScanTestCase):
+    def test_large_file_truncated_while_read(self):
+        path = os.path.join(self.source_dir, 'image')
+        with open(path, 'wb') as f:
+            f.truncate(300 * 1024 * 1024)  # Sparse, large files used to be memory mapped
+        read_size = 0
+        with open(path, 'rb', buffering=0) as file_reader:
+            for i, file_bytes in enumerate(pSync.read_file(file_reader, 16 * 1024 * 1024)):
+                read_size += len(file_bytes)
+                if i == 0:
+                    os.truncate(path, 1024 * 1024)
+        self.assertLess(read_size, 300 * 1024 * 1024)
+
+
+class FileHashTest(ScanTestCase):
+    def test_given_stat_used(self):
+        self.write('a', 'content of a')
+        path = os.path.join(self.source_dir, 'a')
+        file_stat = os.stat(path)
+        file_stat = os.stat_result((file_stat.st_mode, 0, 0, 0, 0, 0, 1234, 0, 5678, 0))
+        self.assertEqual(pSync.get_file_hash(path, 'time', file_stat=file_stat), '1234:5678')
+        self.assertEqual(pSync.get_file_hash(path, 'time'), '12:%d' % os.path.getmtime(path))
+
+    def test_missing_file(self):
+        self.assertIsNone(pSync.get_file_hash(os.path.join(self.source_dir, 'missing'), 'sha256'))
+        self.assertIsNone(pSync.get_file_hash(self.source_dir, 'sha256'))
+
+    def test_file_deleted_after_stat(self):
+        self.write('a', 'content of a')
+        path = os.path.join(self.source_dir, 'a')
+        file_stat = os.stat(path)
+        os.remove(path)
+        copy_to = os.path.join(self.work_dir, 'copy', 'a')
+        self.assertIsNone(pSync.get_file_hash(path, 'sha256', copy_to, file_stat=file_stat))
+        self.assertFalse(os.path.exists(copy_to))
+
+    def test_file_deleted_while_queued(self):
+        self.write('a', 'content of a')
+        self.write('b', 'content of b')
+        self.scan()
+        get_file_hash = pSync.get_file_hash
+
+        def delete_and_hash(file, *args, **kwargs):
+            if os.path.basename(file) == 'b':
+                os.remove(file)
+            return get_file_hash(file, *args, **kwargs)
+
+        with mock.patch('pSync.get_file_hash', delete_and_hash):
+            self.assertEqual(self.scan(paranoid=True), ['DELETED b'])
+
+
+class ListFilesTest(ScanTestCase):
+    def test_directory_deleted_while_listed(self):
+        self.write('d/a/file', 'content')
+        self.write('file', 'content')
+        names = []
+        for entry in pSync.list_files(self.source_dir):
+            names.append(os.path.relpath(entry.path, self.source_dir))
+            if entry.name == 'd':
+                shutil.rmtree(entry.path)
+        self.assertEqual(sorted(names), ['d', 'file'])
+
+
+class CopyFileTest(ScanTestCase):
+    def test_zero_copy_copying_nothing(self):
+        self.write('a', 'content of a')
+        target_file = os.path.join(self.work_dir, 'a')
+        with mock.patch('os.copy_file_range', return_value=0, create=True), \
+                mock.patch('os.sendfile', return_value=0, create=True):
+            pSync.copy_file(os.path.join(self.source_dir, 'a'), target_file)
+        with open(target_file) as f:
+            self.assertEqual(f.read(), 'content of a')
+
+
+class ListingCacheTest(ScanTestCase):
+    """Directories that did not change are not listed again"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory_time_margin = pSync.HashDatabase.directory_time_margin
+        pSync.HashDatabase.directory_time_margin = 0  # Directories written by the test are saved right away
+        self.write('d/a', 'content of a')
+        self.write('e/b', 'content of b')
+        self.scan()
+
+    def tearDown(self):
+        pSync.HashDatabase.directory_time_margin = self.directory_time_margin
+        super().tearDown()
+
+    def scan_listed(self):
+        """
+        :return: tuple (sorted changes, sorted directories listed by os.scandir relative to source directory)
+        """
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            changes = self.scan()
+        return sorted(changes), sorted(os.path.relpath(call[0][0], self.source_dir) for call in scandir.call_args_list)
+
+    def test_unchanged_tree(self):
+        self.assertEqual(self.scan_listed(), ([], []))
+
+    def test_added_file(self):
+        self.write('d/c', 'content of c')
+        self.assertEqual(self.scan_listed(), (['NEW d/c'], ['d']))
+        self.assertEqual(self.scan_listed(), ([], []))
+
+    def test_deleted_subdirectory(self):
+        shutil.rmtree(os.path.join(self.source_dir, 'e'))
+        self.assertEqual(self.scan_listed(), (['DELETED e/b'], ['.']))
+        self.assertEqual(self.scan_listed(), ([], []))
+
+    def test_dangling_symlink(self):
+        target_dir = os.path.join(self.work_dir, 'target')
+        os.mkdir(target_dir)
+        with open(os.path.join(target_dir, 'f'), 'wt') as f:
+            f.write('content of f')
+        os.symlink(target_dir, os.path.join(self.source_dir, 'link'))
+        self.assertEqual(self.scan(), ['NEW link/f'])
+        self.assertEqual(self.scan_listed(), ([], []))
+        shutil.rmtree(target_dir)
+        self.assertEqual(self.scan_listed(), (['DELETED link/f'], ['.']))
+        self.assertEqual(self.scan_listed(), ([], ['.']))
+
+
+class RenameOrderTest(ScanTestCase):
+    """Files are listed in reverse order of names, so new names are verified before the old ones"""
+
+    def setUp(self):
+        super().setUp()
+        self.list_files = pSync.list_files
+        pSync.list_files = lambda *args, **kwargs: iter(sorted(self.list_files(*args, **kwargs),
+                                                               key=lambda entry: entry.name, reverse=True))
+
+    def tearDown(self):
+        pSync.list_files = self.list_files
+        pSync.HashDatabase.batch_size = 500
+        super().tearDown()
+
+    def check_rename_with_new_file(self):
+        self.write('a', 'old a')
+        self.scan()
+        self.move('a', 'b')
+        self.write('a', 'new a!')
+        self.assertEqual(self.scan(), ['RENAMED a to b', 'NEW a'])
+        self.assertEqual(self.scan(), [])
+        self.assertEqual(self.scan(paranoid=True), [])
+
+    def test_rename_with_new_file(self):
+        self.check_rename_with_new_file()
+
+    def test_rename_with_new_file_in_other_batch(self):
+        pSync.HashDatabase.batch_size = 1
+        self.check_rename_with_new_file()
+
+    def test_rename_chain(self):
+        self.write('a', 'content of a')
+        self.write('b', 'content of b')
+        self.scan()
+        self.move('b', 'c')
+        self.move('a', 'b')
+        self.assertEqual(self.scan(), ['RENAMED b to c', 'RENAMED a to b'])
+        self.assertEqual(self.scan(paranoid=True), [])
+
+    def test_rename_chain_with_rewritten_file(self):
+        self.write('b', 'content of b')
+        self.scan()
+        self.move('b', 'c')
+        self.write('b', 'rewritten b')
+        self.assertEqual(self.scan(), ['RENAMED b to c', 'NEW b'])
+        self.assertEqual(self.scan(paranoid=True), [])
+
+
+class TextModeTest(ScanTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hash_file = os.path.join(self.work_dir, 'hashes.txt')
+
+    def test_renames_found_by_default(self):
+        self.write('a', 'content of a')
+        self.scan(use_sql=False)
+        self.move('a', 'b')
+        self.assertEqual(self.scan(use_sql=False), ['RENAMED a to b'])
+
+    def test_renames_not_looked_for(self):
+        self.write('a', 'content of a')
+        self.scan(use_sql=False)
+        self.move('a', 'b')
+        self.assertEqual(sorted(self.scan(use_sql=False, allow_rename=False)), ['DELETED a', 'NEW b'])
+
+    def test_recheck_of_modified_files(self):
+        self.write('a', 'content of a')
+        self.write('b', 'content of b')
+        self.scan(use_sql=False)
+        self.write('b', 'changed b')
+        get_file_hash = pSync.get_file_hash
+
+        def misread_hash(file, *args, **kwargs):
+            if os.path.basename(file) == 'a':
+                return '%064x' % 1  # Read error, the file did not change
+            return get_file_hash(file, *args, **kwargs)
+
+        with mock.patch('pSync.get_file_hash', misread_hash):
+            self.assertEqual(self.scan(use_sql=False, recheck=True), ['MODIFIED b'])
+            self.assertEqual(self.scan(use_sql=False), ['MODIFIED a'])
+
+
+class SinglePassTest(ScanTestCase):
+    def setUp(self):
+        super().setUp()
+        self.get_file_hash = pSync.get_file_hash
+        self.copied_files = []
+
+        def get_file_hash(file, algorithm, copy_to=None, *args, **kwargs):
+            if copy_to is not None:
+                self.copied_files.append(os.path.relpath(file, self.source_dir))
+            return self.get_file_hash(file, algorithm, copy_to, *args, **kwargs)
+
+        pSync.get_file_hash = get_file_hash
+
+    def tearDown(self):
+        pSync.get_file_hash = self.get_file_hash
+        super().tearDown()
+
+    def test_renamed_files_not_copied(self):
+        target_dir = os.path.join(self.work_dir, 'dst')
+        self.write('lib/a', 'content of a')
+        self.write('lib/b', 'content of b')
+        self.scan(True, target_dir=target_dir)
+        self.move('lib', 'library')
+        self.write('new', 'new file')
+        self.assertEqual(sorted(self.scan(True, target_dir=target_dir, single_pass=True)),
+                         ['NEW new', 'RENAMED lib/a to library/a', 'RENAMED lib/b to library/b'])
+        self.assertEqual(self.copied_files, ['new'])
+        for name in ('new', 'library/a', 'library/b'):
+            self.assertTrue(os.path.isfile(os.path.join(target_dir, name)))
+
+
+class MultiRootTest(ScanTestCase):
+    def setUp(self):
+        super().setUp()
+        self.lock_timeout = pSync.HashDatabase.lock_timeout
+        pSync.HashDatabase.lock_timeout = 10  # Fail instead of waiting for long when connections lock each other
+
+    def tearDown(self):
+        pSync.HashDatabase.lock_timeout = self.lock_timeout
+        super().tearDown()
+
+    def test_roots_scanned_into_old_database(self):
+        connection = sqlite3.connect(self.hash_file)
+        connection.execute('CREATE TABLE "hashes" ( `file` TEXT NOT NULL UNIQUE, `hash` TEXT NOT NULL,'
+                           ' `modified` INTEGER NOT NULL DEFAULT 0, `found` INTEGER NOT NULL DEFAULT 1 )')
+        connection.executemany('INSERT INTO "hashes" VALUES (?, ?, 0, 1)',
+                               [('d%d/f%d' % (i % 100, i), '%064x' % i) for i in range(5000)])
+        connection.commit()
+        connection.close()
+        source_dirs = []
+        for i in range(3):
+            self.write('r%d/file' % i, 'root %d' % i)
+            source_dirs.append(os.path.join(self.source_dir, 'r%d' % i))
+        scanner = pSync.MultiScanner(pSync.Config(None, hash_file=self.hash_file, root_jobs=3), source_dirs)
+        try:
+            self.assertEqual(sorted(str(change) for change in scanner.scan()),
+                             sorted('INDEXED %s' % os.path.join(source_dir, 'file') for source_dir in source_dirs))
+        finally:
+            scanner.close()
+        database = pSync.HashDatabase(self.hash_file, 0)
+        try:
+            self.assertEqual(database.find_hash('%064x' % 5), [('', 'd5/f5')])  # Old hashes stay in the default root
+        finally:
+            database.close()
+
+    def test_named_root_scanned_alone(self):
+        source_dirs = []
+        for i in range(2):
+            self.write('r%d/file' % i, 'root %d' % i)
+            source_dirs.append(os.path.join(self.source_dir, 'r%d' % i))
+        scanner = pSync.MultiScanner(pSync.Config(None, hash_file=self.hash_file), source_dirs)
+        try:
+            list(scanner.scan())
+        finally:
+            scanner.close()
+        self.write('r0/new', 'new file')
+        engine = pSync.SyncEngine(pSync.Config(source_dirs[0], hash_file=self.hash_file))
+        try:
+            self.assertEqual([str(change) for change in engine.scan() if change.kind != pSync.Change.OK], ['NEW new'])
+        finally:
+            engine.close()
+
+
+class StatsTest(ScanTestCase):
+    def test_scans_at_once(self):
+        other_dir = os.path.join(self.work_dir, 'other')
+        os.mkdir(other_dir)
+        for i in range(3):
+            self.write('f%d' % i, 'content %d' % i)
+            with open(os.path.join(other_dir, 'f%d' % i), 'wt') as f:
+                f.write('other content %d' % i)
+        self.write('f3', 'content 3')
+        engine = pSync.SyncEngine(pSync.Config(self.source_dir, hash_file=self.hash_file))
+        other_engine = pSync.SyncEngine(pSync.Config(other_dir, hash_file=os.path.join(self.work_dir, 'other.db')))
+        try:
+            scan = engine.scan()
+            next(scan)
+            self.assertEqual(len(list(other_engine.scan())), 3)
+            self.assertEqual(len(list(scan)), 3)
+        finally:
+            engine.close()
+            other_engine.close()
+        self.assertEqual(engine.stats.get('scan', 'files'), 4)
+        self.assertEqual(other_engine.stats.get('scan', 'files'), 3)
+        self.assertEqual(engine.stats.get('hashing', 'files'), 4)
+        self.assertEqual(other_engine.stats.get('hashing', 'files'), 3)
+
+
+class StoreTest(ScanTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store_dir = os.path.join(self.work_dir, 'store')
+
+    def store(self):
+        return sorted(self.scan(True, store_dir=self.store_dir))
+
+    def objects(self):
+        """
+        :return: sorted paths of stored objects and of directories under the objects directory
+        """
+        objects_dir = os.path.join(self.store_dir, 'objects')
+        return sorted(os.path.relpath(os.path.join(path, name), objects_dir)
+                      for path, directories, files in os.walk(objects_dir) for name in directories + files)
+
+    def tree_stat(self, name):
+        return os.stat(os.path.join(self.store_dir, 'tree', name))
+
+    def test_objects_stored_once_and_deleted_when_unused(self):
+        same_hash = hashlib.sha256(b'same content').hexdigest()
+        other_hash = hashlib.sha256(b'other content').hexdigest()
+        self.write('a', 'same content')
+        self.write('d/b', 'same content')
+        self.write('c', 'other content')
+        self.store()
+        self.assertEqual(self.objects(), sorted([same_hash[:2], os.path.join(same_hash[:2], same_hash[2:]),
+                                                 other_hash[:2], os.path.join(other_hash[:2], other_hash[2:])]))
+        self.assertEqual(self.tree_stat('a').st_ino, self.tree_stat('d/b').st_ino)
+
+        self.move('c', 'e')
+        self.assertEqual(self.store(), ['RENAMED c to e'])
+        self.assertFalse(os.path.exists(os.path.join(self.store_dir, 'tree', 'c')))
+        with open(os.path.join(self.store_dir, 'tree', 'e')) as f:
+            self.assertEqual(f.read(), 'other content')
+
+        os.remove(os.path.join(self.source_dir, 'a'))
+        self.assertEqual(self.store(), ['DELETED a'])
+        self.assertIn(os.path.join(same_hash[:2], same_hash[2:]), self.objects())  # Still used by d/b
+
+        os.remove(os.path.join(self.source_dir, 'e'))
+        self.write('d/b', 'changed content')
+        changed_hash = hashlib.sha256(b'changed content').hexdigest()
+        self.assertEqual(self.store(), ['DELETED e', 'MODIFIED d/b'])
+        self.assertEqual(self.objects(), [changed_hash[:2], os.path.join(changed_hash[:2], changed_hash[2:])])
+        with open(os.path.join(self.store_dir, 'manifest.txt')) as f:
+            self.assertEqual(f.read().splitlines()[1:], ['%s d/b' % changed_hash])
+
+
+class QueryTest(ScanTestCase):
+    def query(self, **kwargs):
+        """
+        :return: tuple (printed lines, exit code or None)
+        """
+        output = io.StringIO()
+        code = None
+        with contextlib.redirect_stdout(output):
+            try:
+                pSync.query_database(self.hash_file, **kwargs)
+            except SystemExit as e:
+                code = e.code
+        return output.getvalue().splitlines(), code
+
+    def test_database_not_changed(self):
+        self.write('a', 'content of a')
+        self.scan()
+        with open(self.hash_file, 'rb') as f:
+            content = f.read()
+        connection = sqlite3.connect(self.hash_file)
+        connection.execute('BEGIN IMMEDIATE')  # Running scan does not make the query wait
+        try:
+            self.assertEqual(self.query(find_hash=hashlib.sha256(b'content of a').hexdigest()), (['a'], None))
+        finally:
+            connection.rollback()
+            connection.close()
+        with open(self.hash_file, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_invalid_database(self):
+        with open(self.hash_file, 'wt') as f:
+            f.write('1234 a\n')
+        lines, code = self.query(duplicates=True)
+        self.assertEqual(code, 1)
+        self.assertTrue(lines[0].startswith('Database "%s" is invalid' % self.hash_file))
+
+
+if __name__ == '__main__':
+    unittest.main()